@@ -1,29 +1,264 @@
-from flask import Flask, render_template, flash, redirect, request, abort, url_for, g
+from flask import Flask, render_template, flash, redirect, request, abort, url_for, g, session, has_app_context, has_request_context, make_response, jsonify, Response, stream_with_context, send_file
 from flask_wtf import FlaskForm
 from wtforms import StringField, PasswordField, BooleanField, SubmitField
 from wtforms.validators import DataRequired
 from flask_sqlalchemy import SQLAlchemy
+from flask_sqlalchemy.session import Session
+import sqlalchemy
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+from sqlalchemy.exc import OperationalError
+from markupsafe import Markup
+import jinja2
+import itsdangerous
 from flask_login import LoginManager, login_user, logout_user, login_required, current_user
+import click
+import contextlib
 import datetime
+import decimal
 from datetime import timedelta
 import time
 import json
+import csv
+import re
+import io
 import locale
 import os
+import threading
+import functools
+import hashlib
+import urllib.parse
+import sqlite3
+import traceback
+from concurrent.futures import ThreadPoolExecutor
+import metrics
+import cache
+import settle
+import receipts
+import events
+import chores
 
 locale.setlocale(locale.LC_ALL, 'en_US.utf8')
-roommates = ['Russell', 'Alex', 'Eli'] # do not change order
+roommates = ['Russell', 'Alex', 'Eli'] # seeds the first household's members, in this order (see migrate-members)
 spending_types = ['grocery', 'rent', 'bill', 'maintenance', 'restaurant', 'furniture/appliance', 'fun', 'miscellaneous'] # all should be lowercase
 payment_methods = ['venmo', 'cash', 'check', 'zelle', 'other'] # all should be lowercase
 SECRET_KEY = os.urandom(32)
 app = Flask(__name__, static_url_path='/static')
 app.config['SECRET_KEY'] = SECRET_KEY
-app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///database.db'
+app.config['SQLALCHEMY_DATABASE_URI'] = os.environ.get('DATABASE_URI', 'sqlite:///database.db')
+app.config['SERVER_TIMING'] = 'SERVER_TIMING' in os.environ
+app.config['METRICS_TOKEN'] = os.environ.get('METRICS_TOKEN') # bearer token for scraping /metrics without logging in
+app.config['HOST'] = os.environ.get('HOST', '0.0.0.0')
+app.config['PORT'] = int(os.environ.get('PORT', 5000))
+app.config['THREADS'] = int(os.environ.get('THREADS', 8)) # waitress worker threads
+app.config['SQLITE_BUSY_TIMEOUT'] = int(os.environ.get('SQLITE_BUSY_TIMEOUT', 5000)) # ms to wait on a locked database
+app.config['SQLITE_MMAP_SIZE'] = int(os.environ.get('SQLITE_MMAP_SIZE', 256 * 1024 * 1024))
+sqlite_file = sqlalchemy.engine.make_url(app.config['SQLALCHEMY_DATABASE_URI']).database not in (None, '', ':memory:')
+if sqlite_file:
+    # one connection per waitress thread plus a little headroom for the scheduler and cli
+    app.config['SQLALCHEMY_ENGINE_OPTIONS'] = {'pool_size': app.config['THREADS'], 'max_overflow': 4, 'pool_timeout': 30}
+app.config['SEND_FILE_MAX_AGE_DEFAULT'] = int(os.environ.get('STATIC_MAX_AGE', 7 * 24 * 60 * 60)) # Cache-Control max-age for static/
+app.config['PAGE_CACHE_DIR'] = os.environ.get('PAGE_CACHE_DIR') # keep rendered fragments on disk instead of in memory
+# GET routes marked @read_only read through a separate read-only connection
+app.config['READ_ONLY_GETS'] = sqlite_file and 'NO_READ_ONLY_GETS' not in os.environ
+app.config['HOUSEHOLD_DIR'] = os.environ.get('HOUSEHOLD_DIR', 'households') # per-household tasks.txt
+app.config['PAGE_CACHE_SIZE'] = int(os.environ.get('PAGE_CACHE_SIZE', 256)) # fragments kept in memory
+app.config['RECEIPT_DIR'] = os.environ.get('RECEIPT_DIR', 'receipts')
+app.config['RECEIPT_MAX_BYTES'] = int(os.environ.get('RECEIPT_MAX_BYTES', 10 * 1024 * 1024))
+app.config['RECEIPT_WORKERS'] = int(os.environ.get('RECEIPT_WORKERS', 2)) # threads making thumbnails
+app.config['RECEIPT_MAX_AGE'] = 365 * 24 * 60 * 60 # receipt files never change, see receipts.py
+# werkzeug refuses bigger requests before parsing them. leaves room for the other form fields.
+app.config['MAX_CONTENT_LENGTH'] = app.config['RECEIPT_MAX_BYTES'] + 64 * 1024
+# live updates are streamed from their own port, see events.py. 0 turns them off.
+app.config['EVENTS_PORT'] = int(os.environ.get('EVENTS_PORT', app.config['PORT'] + 1))
+app.config['EVENTS_URL'] = os.environ.get('EVENTS_URL') # what browsers connect to, if not <this host>:EVENTS_PORT/events
+app.config['EVENTS_TOKEN_MAX_AGE'] = 24 * 60 * 60
+app.config['AUDIT_RETENTION_DAYS'] = int(os.environ.get('AUDIT_RETENTION_DAYS', 365)) # full history is kept this long, see compact-audit-log
+app.config['TEMPLATE_CACHE_DIR'] = os.environ.get('TEMPLATE_CACHE_DIR', 'template_cache') # compiled templates, see compile-templates
+metrics.init_app(app)
+# templates are compiled to python bytecode once and loaded from disk after
+# that, so a fresh process doesn't parse every template again. entries are
+# keyed by the template's source, so an edited template is just recompiled.
+os.makedirs(app.config['TEMPLATE_CACHE_DIR'], exist_ok=True)
+app.jinja_env.bytecode_cache = jinja2.FileSystemBytecodeCache(app.config['TEMPLATE_CACHE_DIR'])
+
+def build_stamp():
+    # changes whenever this file or a template does, so etags and cached
+    # fragments from before a deploy are never reused for the new markup
+    paths = [os.path.abspath(__file__)]
+    for directory, _, filenames in os.walk(os.path.join(app.root_path, app.template_folder)):
+        paths.extend([os.path.join(directory, filename) for filename in filenames])
+    stamps = [(path, os.stat(path).st_mtime_ns, os.stat(path).st_size) for path in sorted(paths)]
+    return hashlib.sha1(repr(stamps).encode('utf-8')).hexdigest()[:12]
+
+BUILD_STAMP = build_stamp()
 login_manager = LoginManager()
 login_manager.init_app(app)
-db = SQLAlchemy()
+
+class RoutingSession(Session):
+    # sends queries made by @read_only routes to the read-only engine. flushes
+    # always go to the primary engine.
+    def get_bind(self, mapper=None, clause=None, bind=None, **kwargs):
+        if bind is None and not self._flushing and has_request_context() and g.get('read_only'):
+            return get_read_only_engine()
+        return super().get_bind(mapper=mapper, clause=clause, bind=bind, **kwargs)
+
+db = SQLAlchemy(session_options={'class_': RoutingSession})
 db.init_app(app)
 
+DEFAULT_HOUSEHOLD_ID = 1
+
+def current_household_id():
+    # the household a job or cli command is working on (see in_household), or
+    # else the logged-in user's. cli commands default to the first household.
+    if has_app_context() and g.get('household_id') is not None:
+        return g.household_id
+    if has_request_context():
+        return getattr(current_user, 'household_id', None)
+    return DEFAULT_HOUSEHOLD_ID
+
+@contextlib.contextmanager
+def in_household(household_id):
+    previous = g.get('household_id')
+    g.household_id = household_id
+    try:
+        yield
+    finally:
+        g.household_id = previous
+
+def household_option(f):
+    # --household for cli commands that work on one household
+    @click.option('--household', default=DEFAULT_HOUSEHOLD_ID, help='Household id.')
+    @functools.wraps(f)
+    def decorated(*args, household, **kwargs):
+        with in_household(household):
+            return f(*args, **kwargs)
+    return decorated
+
+class HouseholdScoped:
+    # rows that belong to one household. new rows go to the current household
+    # and queries only ever see its rows, see scope_to_household.
+    @sqlalchemy.orm.declared_attr
+    def household_id(cls):
+        return db.Column(db.Integer, db.ForeignKey('household.id'), nullable=False, default=current_household_id)
+
+@sqlalchemy.event.listens_for(RoutingSession, 'do_orm_execute')
+def scope_to_household(execute_state):
+    # pass execution_options(all_households=True) to see every household
+    if not (execute_state.is_select or execute_state.is_update or execute_state.is_delete):
+        return
+    if execute_state.is_column_load or execute_state.is_relationship_load or execute_state.execution_options.get('all_households'):
+        return
+    if not any([issubclass(mapper.class_, HouseholdScoped) for mapper in execute_state.all_mappers]):
+        return
+    household_id = current_household_id()
+    execute_state.statement = execute_state.statement.options(sqlalchemy.orm.with_loader_criteria(HouseholdScoped, lambda cls: cls.household_id == household_id, include_aliases=True))
+
+class SoftDeleted:
+    # rows that are hidden instead of deleted, so they can be restored. queries
+    # don't see them unless they pass execution_options(include_deleted=True).
+    deleted_when = db.Column(db.DateTime)
+
+@sqlalchemy.event.listens_for(RoutingSession, 'do_orm_execute')
+def hide_deleted(execute_state):
+    if not execute_state.is_select or execute_state.is_column_load or execute_state.is_relationship_load:
+        return
+    if execute_state.execution_options.get('include_deleted'):
+        return
+    if not any([issubclass(mapper.class_, SoftDeleted) for mapper in execute_state.all_mappers]):
+        return
+    execute_state.statement = execute_state.statement.options(sqlalchemy.orm.with_loader_criteria(SoftDeleted, lambda cls: cls.deleted_when == None, include_aliases=True))
+
+class Audited:
+    # every insert, update and delete of these is written to the audit log, see log_changes
+    def audit_id(self):
+        # the primary key within the household, like "12" or "2962:3" for a task
+        return ':'.join([str(getattr(self, column.key)) for column in sqlalchemy.inspect(type(self)).primary_key if column.key != 'household_id'])
+
+    def audit_data(self):
+        return dict([(attr.key, getattr(self, attr.key)) for attr in sqlalchemy.inspect(type(self)).column_attrs])
+
+def configure_sqlite(dbapi_connection, read_only=False):
+    if not isinstance(dbapi_connection, sqlite3.Connection):
+        return
+    cursor = dbapi_connection.cursor()
+    if not read_only:
+        # WAL lets readers carry on while someone writes
+        cursor.execute("PRAGMA journal_mode=WAL")
+        cursor.execute("PRAGMA synchronous=NORMAL")
+    cursor.execute("PRAGMA busy_timeout=%d" % app.config['SQLITE_BUSY_TIMEOUT'])
+    cursor.execute("PRAGMA mmap_size=%d" % app.config['SQLITE_MMAP_SIZE'])
+    cursor.close()
+
+with app.app_context():
+    sqlalchemy.event.listen(db.engine, 'connect', lambda dbapi_connection, connection_record: configure_sqlite(dbapi_connection))
+
+read_only_engine = None
+read_only_engine_lock = threading.Lock()
+
+def get_read_only_engine():
+    global read_only_engine
+    with read_only_engine_lock:
+        if read_only_engine is None:
+            path = db.engine.url.database
+            read_only_engine = sqlalchemy.create_engine('sqlite://', creator=lambda: sqlite3.connect('file:%s?mode=ro' % path, uri=True, check_same_thread=False), pool_size=app.config['THREADS'], max_overflow=4, poolclass=sqlalchemy.pool.QueuePool)
+            sqlalchemy.event.listen(read_only_engine, 'connect', lambda dbapi_connection, connection_record: configure_sqlite(dbapi_connection, read_only=True))
+    return read_only_engine
+
+if app.config['PAGE_CACHE_DIR']:
+    page_cache = cache.DiskCache('pages', app.config['PAGE_CACHE_DIR'])
+else:
+    page_cache = cache.LRUCache('pages', maxsize=app.config['PAGE_CACHE_SIZE'])
+
+def version_name(name, household_id=None):
+    return "%s:%s" % (name, household_id if household_id is not None else current_household_id())
+
+def bump_version(name, household_id=None):
+    db.session.execute(sqlite_insert(DataVersion).values(name=version_name(name, household_id), version=1).on_conflict_do_update(index_elements=['name'], set_={'version': DataVersion.version + 1}))
+
+def get_version(name, household_id=None):
+    version = db.session.get(DataVersion, version_name(name, household_id))
+    return version.version if version is not None else 0
+
+def cached_fragment(key, render):
+    # key must include the data version(s) the fragment was rendered from
+    key = (BUILD_STAMP,) + tuple(key)
+    html = page_cache.get(key)
+    if html is None:
+        html = render()
+        page_cache.set(key, html)
+    return Markup(html)
+
+def conditional(*names):
+    # answers If-None-Match with a 304 before the view runs any queries. the
+    # etag covers the data versions the page is built from, who is asking and
+    # the current week and the build, so it changes whenever the rendered
+    # page would.
+    def decorator(f):
+        @functools.wraps(f)
+        def decorated(*args, **kwargs):
+            if '_flashes' in session:
+                return f(*args, **kwargs)
+            stamp = [BUILD_STAMP, request.full_path, current_user.name, get_week_id()] + [get_version(name) for name in names]
+            etag = hashlib.sha1(repr(stamp).encode('utf-8')).hexdigest()
+            if request.if_none_match.contains_weak(etag):
+                response = Response(status=304)
+            else:
+                response = make_response(f(*args, **kwargs))
+            response.set_etag(etag, weak=True)
+            response.headers['Cache-Control'] = 'private, no-cache'
+            return response
+        return decorated
+    return decorator
+
+def read_only(f):
+    # only affects GET requests, so routes that also accept POST can use it
+    @functools.wraps(f)
+    def decorated(*args, **kwargs):
+        if app.config['READ_ONLY_GETS'] and request.method == 'GET':
+            g.read_only = True
+        return f(*args, **kwargs)
+    return decorated
+
 @app.route('/')
 @login_required
 def index():
@@ -31,59 +266,305 @@ def index():
 
 @login_manager.unauthorized_handler
 def unauthorized_callback():
+    if request.path.startswith('/api/'):
+        return jsonify(error="Not logged in."), 401
     return redirect('/login?next=' + request.path)
 
-class GroceryItem(db.Model):
+class Household(db.Model):
+    __tablename__ = 'household'
+    id = db.Column(db.Integer, primary_key=True, autoincrement=True)
+    name = db.Column(db.String)
+
+class Member(Audited, db.Model):
+    # purchases, transfers, balances and rollups refer to people by member id.
+    # the first household's ids are the old positions in roommates, so rows
+    # written before migrate-members stay valid.
+    __tablename__ = 'member'
+    __table_args__ = (db.UniqueConstraint('household_id', 'name'),)
+    id = db.Column(db.Integer, primary_key=True, autoincrement=True)
+    household_id = db.Column(db.Integer, db.ForeignKey('household.id'), nullable=False, index=True)
+    name = db.Column(db.String, nullable=False)
+
+class GroceryItem(HouseholdScoped, Audited, db.Model):
     __tablename__ = 'grocery'
+    __table_args__ = (db.Index('ix_grocery_household_bought', 'household_id', 'recently_bought', 'bought_when'),)
     id = db.Column(db.Integer, primary_key=True, autoincrement=True)
     name = db.Column(db.String)
     quantity = db.Column(db.Integer)
     note = db.Column(db.String)
-    votes = db.Column(db.Integer, default=0)
+    votes = db.Column(db.Integer, default=0) # legacy bitmask, superseded by voters (see migrate-members)
     recently_bought = db.Column(db.Boolean, default=False)
     bought_by = db.Column(db.String)
     added_when = db.Column(db.DateTime, default=datetime.datetime.utcnow)
     bought_when = db.Column(db.DateTime, default=datetime.datetime.utcnow)
+    voters = db.relationship('GroceryVote', cascade='all, delete-orphan', order_by='GroceryVote.member_id')
 
-class Receipt(db.Model):
+    def audit_data(self):
+        data = Audited.audit_data(self)
+        data['voters'] = [vote.member_id for vote in self.voters]
+        return data
+
+class GroceryVote(db.Model):
+    __tablename__ = 'grocery_vote'
+    grocery_id = db.Column(db.Integer, db.ForeignKey('grocery.id'), primary_key=True)
+    member_id = db.Column(db.Integer, db.ForeignKey('member.id'), primary_key=True)
+
+class Receipt(HouseholdScoped, db.Model):
+    # an uploaded receipt file, stored once per content hash (see receipts.py).
+    # thumbnails and itemdata are filled in by process_receipt in the background.
+    __table_args__ = (db.Index('ix_receipt_household_sha256', 'household_id', 'sha256', unique=True),)
     id = db.Column(db.Integer, primary_key=True, autoincrement=True)
     added_when = db.Column(db.DateTime, default=datetime.datetime.utcnow)
-    itemdata = db.Column(db.String)
-    image_file = db.Column(db.String)
+    itemdata = db.Column(db.String) # json details about the file
+    image_file = db.Column(db.String) # path under RECEIPT_DIR
+    sha256 = db.Column(db.String)
+    content_type = db.Column(db.String)
+    size = db.Column(db.Integer)
+    status = db.Column(db.String, default='pending') # pending, ready or failed
+    has_thumbnail = db.Column(db.Boolean, default=False)
 
-class Purchase(db.Model):
+class Purchase(HouseholdScoped, SoftDeleted, Audited, db.Model):
+    __table_args__ = (db.Index('ix_purchase_household_dated', 'household_id', sqlalchemy.text('coalesce(bought_when, added_when)'), 'added_when', 'id'),)
     id = db.Column(db.Integer, primary_key=True, autoincrement=True)
     name = db.Column(db.String)
     added_when = db.Column(db.DateTime, default=datetime.datetime.utcnow)
     bought_when = db.Column(db.DateTime)
     bought_by = db.Column(db.Integer)
-    bought_for = db.Column(db.Integer)
+    bought_for = db.Column(db.Integer) # legacy bitmask, superseded by shares (see migrate-members)
     spending_type = db.Column(db.String)
-    price = db.Column(db.Float)
-    totals = db.Column(db.String)
+    price = db.Column(db.Float) # legacy dollars, superseded by price_cents (see migrate-cents)
+    price_cents = db.Column(db.Integer)
+    totals = db.Column(db.String) # legacy comma-joined split, superseded by shares (see migrate-shares)
     split_mode = db.Column(db.String)
     receipt_id = db.Column(db.Integer, default=-1)
     additional_info = db.Column(db.String)
+    shares = db.relationship('PurchaseShare', cascade='all, delete-orphan', order_by='PurchaseShare.roommate_id')
+
+    def audit_data(self):
+        data = Audited.audit_data(self)
+        data['shares'] = [[share.roommate_id, share.share] for share in self.shares]
+        return data
 
-class MoneyTransfer(db.Model):
+class PurchaseShare(db.Model):
+    # one row per beneficiary of a purchase: how much of it that member is on
+    # the hook for, in cents
+    __tablename__ = 'purchase_share'
+    purchase_id = db.Column(db.Integer, db.ForeignKey('purchase.id'), primary_key=True)
+    roommate_id = db.Column(db.Integer, primary_key=True, index=True)
+    share = db.Column(db.Integer, nullable=False)
+
+class MoneyTransfer(HouseholdScoped, SoftDeleted, Audited, db.Model):
+    __table_args__ = (db.Index('ix_money_transfer_household_dated', 'household_id', sqlalchemy.text('coalesce(transferred_when, added_when)'), 'added_when', 'id'),)
     id = db.Column(db.Integer, primary_key=True, autoincrement=True)
     name = db.Column(db.String)
     who_paid = db.Column(db.Integer)
-    amount = db.Column(db.Float)
+    amount = db.Column(db.Float) # legacy dollars, superseded by amount_cents (see migrate-cents)
+    amount_cents = db.Column(db.Integer)
     to_whom = db.Column(db.Integer)
     added_when = db.Column(db.DateTime, default=datetime.datetime.utcnow)
     transferred_when = db.Column(db.DateTime)
     method = db.Column(db.String)
     additional_info = db.Column(db.String)
 
-class WeeklyTasks(db.Model):
+class Balance(HouseholdScoped, db.Model):
+    # materialized owes matrix: amount is how many cents debtor owes creditor,
+    # before netting. kept in sync by apply_to_ledger on every write.
+    __tablename__ = 'balance'
+    __table_args__ = (db.Index('ix_balance_household', 'household_id'),)
+    debtor = db.Column(db.Integer, primary_key=True)
+    creditor = db.Column(db.Integer, primary_key=True)
+    amount = db.Column(db.Integer, default=0)
+
+class SpendingRollup(HouseholdScoped, db.Model):
+    # purchase totals in cents per period, spending type and roommate, either as
+    # the payer or as a beneficiary. kept in sync by apply_purchase.
+    __tablename__ = 'spending_rollup'
+    __table_args__ = (db.Index('ix_spending_rollup_household_series', 'household_id', 'period', 'role', 'roommate_id', 'period_start'),)
+    period = db.Column(db.String, primary_key=True) # day, week or month
+    period_start = db.Column(db.Date, primary_key=True)
+    spending_type = db.Column(db.String, primary_key=True)
+    roommate_id = db.Column(db.Integer, primary_key=True)
+    role = db.Column(db.String, primary_key=True) # payer or beneficiary
+    amount = db.Column(db.Integer, default=0)
+
+class WeeklyTasks(HouseholdScoped, db.Model):
     __tablename__ = 'weekly_tasks'
+    household_id = db.Column(db.Integer, db.ForeignKey('household.id'), primary_key=True, default=current_household_id)
     week_id = db.Column(db.Integer, primary_key=True)
-    obj = db.Column(db.String)
+    obj = db.Column(db.String) # legacy json blob, superseded by Task rows (see migrate-tasks)
+
+class Task(HouseholdScoped, Audited, db.Model):
+    __tablename__ = 'task'
+    __table_args__ = (
+        db.ForeignKeyConstraint(['household_id', 'week_id'], ['weekly_tasks.household_id', 'weekly_tasks.week_id']),
+        db.Index('ix_task_household_week_assigned', 'household_id', 'week_id', 'assigned_to'),
+    )
+    household_id = db.Column(db.Integer, primary_key=True, default=current_household_id)
+    week_id = db.Column(db.Integer, primary_key=True)
+    task_id = db.Column(db.Integer, primary_key=True)
+    name = db.Column(db.String)
+    assigned_to = db.Column(db.String) # member name, as spelled in the member table
+    completed = db.Column(db.Boolean, default=False)
+    overdue = db.Column(db.Boolean, default=False)
+
+class AuditEvent(HouseholdScoped, db.Model):
+    # append-only log of changes to the Audited models. data is a json copy of
+    # the row after the change (before it, for deletes). only compact-audit-log
+    # ever removes events.
+    __tablename__ = 'audit_event'
+    __table_args__ = (db.Index('ix_audit_event_household_entity', 'household_id', 'entity_type', 'entity_id', 'id'),)
+    id = db.Column(db.Integer, primary_key=True, autoincrement=True)
+    at = db.Column(db.DateTime, default=datetime.datetime.utcnow)
+    actor = db.Column(db.String) # user name, or None for jobs and cli commands
+    entity_type = db.Column(db.String) # table name
+    entity_id = db.Column(db.String) # see Audited.audit_id
+    action = db.Column(db.String) # create, update, delete or restore
+    data = db.Column(db.String)
+
+def audit_actor():
+    return getattr(current_user, 'name', None) if has_request_context() else None
+
+def audit_row(entity_type, entity_id, action, data, household_id):
+    data = json.dumps(data, separators=(',', ':'), default=lambda value: value.isoformat())
+    return {'household_id': household_id, 'at': datetime.datetime.utcnow(), 'actor': audit_actor(), 'entity_type': entity_type, 'entity_id': entity_id, 'action': action, 'data': data}
+
+@sqlalchemy.event.listens_for(RoutingSession, 'after_flush')
+def log_changes(session, flush_context):
+    # written on the flush's connection, so the events commit or roll back
+    # together with the changes they describe
+    changes = []
+    for obj in session.new:
+        if isinstance(obj, Audited):
+            changes.append((obj, 'create'))
+    for obj in session.dirty:
+        if isinstance(obj, Audited) and session.is_modified(obj):
+            action = 'update'
+            if isinstance(obj, SoftDeleted) and sqlalchemy.inspect(obj).attrs.deleted_when.history.has_changes():
+                action = 'delete' if obj.deleted_when is not None else 'restore'
+            changes.append((obj, action))
+    for obj in session.deleted:
+        if isinstance(obj, Audited):
+            changes.append((obj, 'delete'))
+    if len(changes) > 0:
+        rows = [audit_row(obj.__tablename__, obj.audit_id(), action, obj.audit_data(), obj.household_id) for obj, action in changes]
+        session.connection().execute(AuditEvent.__table__.insert(), rows)
+
+# full-text search over the finance history and groceries, kept up to date
+# by triggers so bulk inserts and cli commands are covered too. rows are
+# keyed by rowid = id * 4 + kind so the triggers can find them without a
+# scan. purged groceries stay searchable as archived rows with negative rowids.
+SEARCH_KINDS = {
+    # kind (table name) -> (rowid offset, name column, text column, date column)
+    'purchase': (0, 'name', 'additional_info', 'bought_when'),
+    'money_transfer': (1, 'name', 'additional_info', 'transferred_when'),
+    'grocery': (2, 'name', 'note', 'added_when'),
+}
+
+SEARCH_COLUMNS = 'rowid, name, body, scope, kind, entity_id, happened, archived'
+
+def search_scope(household_id, kind):
+    # scope holds words for the household and kind, so searches are narrowed
+    # to them by the index itself instead of by filtering every match
+    return "'h' || %s || ' %s'" % (household_id, kind.replace('_', ''))
+
+def search_values(row, kind):
+    offset, name, body, happened = SEARCH_KINDS[kind]
+    return "%s.id * 4 + %d, %s.%s, %s.%s, %s, '%s', %s.id, %s.%s, 0" % (row, offset, row, name, row, body, search_scope(row + '.household_id', kind), kind, row, row, happened)
+
+def search_model(kind):
+    return {'purchase': Purchase, 'money_transfer': MoneyTransfer, 'grocery': GroceryItem}[kind]
+
+def search_triggers():
+    triggers = []
+    for kind, (offset, name, body, happened) in SEARCH_KINDS.items():
+        # soft deleted rows drop out of the index until they're restored
+        visible = 'new.deleted_when IS NULL' if issubclass(search_model(kind), SoftDeleted) else '1'
+        watched = ', '.join([name, body, happened] + (['deleted_when'] if visible != '1' else []))
+        remove = 'DELETE FROM search_index WHERE rowid = old.id * 4 + %d;' % offset
+        add = 'INSERT INTO search_index (%s) SELECT %s WHERE %s;' % (SEARCH_COLUMNS, search_values('new', kind), visible)
+        triggers.append('CREATE TRIGGER IF NOT EXISTS search_%s_insert AFTER INSERT ON %s BEGIN %s END' % (kind, kind, add))
+        triggers.append('CREATE TRIGGER IF NOT EXISTS search_%s_update AFTER UPDATE OF %s ON %s BEGIN %s %s END' % (kind, watched, kind, remove, add))
+        if kind == 'grocery':
+            archive = "INSERT INTO search_index (%s) VALUES (min(0, coalesce((SELECT rowid FROM search_index ORDER BY rowid LIMIT 1), 0)) - 1, old.name, old.note, %s, 'grocery', old.id, coalesce(old.bought_when, old.added_when), 1);" % (SEARCH_COLUMNS, search_scope('old.household_id', 'grocery'))
+            triggers.append('CREATE TRIGGER IF NOT EXISTS search_grocery_delete AFTER DELETE ON grocery BEGIN %s %s END' % (remove, archive))
+        else:
+            triggers.append('CREATE TRIGGER IF NOT EXISTS search_%s_delete AFTER DELETE ON %s BEGIN %s END' % (kind, kind, remove))
+    return triggers
+
+def fill_search_index(connection):
+    # everything the triggers would have added, plus groceries purged before
+    # the index existed: from the audit log and from the old grocery_log.txt files
+    connection.exec_driver_sql('DELETE FROM search_index')
+    for kind in SEARCH_KINDS:
+        hidden = ' WHERE deleted_when IS NULL' if issubclass(search_model(kind), SoftDeleted) else ''
+        connection.exec_driver_sql('INSERT INTO search_index (%s) SELECT %s FROM %s%s' % (SEARCH_COLUMNS, search_values(kind, kind), kind, hidden))
+    connection.exec_driver_sql("INSERT INTO search_index (%s) SELECT -id, json_extract(data, '$.name'), json_extract(data, '$.note'), %s, 'grocery', entity_id, replace(coalesce(json_extract(data, '$.bought_when'), json_extract(data, '$.added_when')), 'T', ' '), 1 FROM audit_event WHERE entity_type = 'grocery' AND action = 'delete'" % (SEARCH_COLUMNS, search_scope('household_id', 'grocery')))
+    archived = []
+    for household_id, path in legacy_grocery_logs(connection):
+        with open(path, 'r') as f:
+            for line in f:
+                fields = line.rstrip('\n').split(',')
+                # id,name,quantity,voters,recently_bought,bought_by,added_when,bought_when,note
+                if line.startswith('#') or len(fields) < 9:
+                    continue
+                # their ids may since have been reused, so they aren't linked to anything
+                archived.append({'name': fields[1], 'body': ','.join(fields[8:]), 'household_id': household_id, 'happened': fields[7]})
+    if len(archived) > 0:
+        first = connection.exec_driver_sql('SELECT min(0, coalesce(min(rowid), 0)) FROM search_index').scalar() - 1
+        for rowid, row in enumerate(archived):
+            row['rowid'] = first - rowid
+        connection.execute(sqlalchemy.text("INSERT INTO search_index (%s) VALUES (:rowid, :name, :body, %s, 'grocery', NULL, :happened, 1)" % (SEARCH_COLUMNS, search_scope(':household_id', 'grocery'))), archived)
+
+def legacy_grocery_logs(connection):
+    # (household id, path) of each grocery_log.txt left over from before the audit log
+    if os.path.exists('grocery_log.txt'):
+        yield DEFAULT_HOUSEHOLD_ID, 'grocery_log.txt'
+    for (household_id,) in connection.exec_driver_sql('SELECT id FROM household'):
+        path = os.path.join(app.config['HOUSEHOLD_DIR'], str(household_id), 'grocery_log.txt')
+        if os.path.exists(path):
+            yield household_id, path
+
+def create_search_index(connection):
+    # run by init-db and rebuild-search rather than on every create_all, since
+    # the triggers and the first fill need columns that an older database only
+    # gets from the migrate- commands and init-db
+    inspector = sqlalchemy.inspect(connection)
+    for kind in SEARCH_KINDS:
+        needed = ['household_id'] + (['deleted_when'] if issubclass(search_model(kind), SoftDeleted) else [])
+        columns = [column['name'] for column in inspector.get_columns(kind)]
+        missing = [column for column in needed if column not in columns]
+        if len(missing) > 0:
+            print("Not creating the search index until %s has %s (see migrate-households)." % (kind, " and ".join(missing)))
+            return False
+    exists = connection.exec_driver_sql("SELECT 1 FROM sqlite_master WHERE name = 'search_index'").first() is not None
+    if not exists:
+        connection.exec_driver_sql("CREATE VIRTUAL TABLE search_index USING fts5(name, body, scope, kind UNINDEXED, entity_id UNINDEXED, happened UNINDEXED, archived UNINDEXED, tokenize = 'unicode61 remove_diacritics 2', prefix = '2 3')")
+        # matches in the name count for more than matches in the notes
+        connection.exec_driver_sql("INSERT INTO search_index (search_index, rank) VALUES ('rank', 'bm25(10.0, 1.0, 0.0)')")
+    for trigger in search_triggers():
+        connection.exec_driver_sql(trigger)
+    if not exists:
+        fill_search_index(connection)
+        print("Created the search index.")
+    return True
+
+class DataVersion(db.Model):
+    # bumped in the same transaction as every write to a part of the app, so
+    # anything cached against the old version is never served again
+    __tablename__ = 'data_version'
+    name = db.Column(db.String, primary_key=True) # part of the app and household id, like finance:1
+    version = db.Column(db.Integer, default=0)
+
+class JobLock(db.Model):
+    # lets only one process at a time run a background job
+    __tablename__ = 'job_lock'
+    name = db.Column(db.String, primary_key=True)
+    locked_until = db.Column(db.DateTime)
 
 class User(db.Model):
     __tablename__ = 'user'
     name = db.Column(db.String, primary_key=True)
+    household_id = db.Column(db.Integer, db.ForeignKey('household.id'), default=DEFAULT_HOUSEHOLD_ID)
     password = db.Column(db.String)
     authenticated = db.Column(db.Boolean, default=False)
     def is_active(self):
@@ -106,6 +587,8 @@ def is_safe_url(url):
 
 @app.route('/logout')
 def logout():
+    if current_user.is_authenticated:
+        user_cache.delete(current_user.name)
     logout_user()
     flash('Logged out.')
     return redirect(url_for('login'))
@@ -114,6 +597,8 @@ def logout():
 def login():
     form = LoginForm()
     if form.validate_on_submit():
+        # always check the password against the database, not the cache
+        user_cache.delete(form.username.data)
         user = user_loader(form.username.data)
         if user is not None and user.name == form.username.data and user.password == form.password.data:
             login_user(user, remember=form.remember_me.data)
@@ -130,12 +615,22 @@ def login():
     else:
         return render_template('login.html', tab='login', form=form)
 
+def household_file(filename, for_writing=False):
+    # the current household's copy of a data file, under HOUSEHOLD_DIR/<id>/.
+    # reads fall back to the shared file in the working directory.
+    directory = os.path.join(app.config['HOUSEHOLD_DIR'], str(current_household_id()))
+    path = os.path.join(directory, filename)
+    if for_writing:
+        os.makedirs(directory, exist_ok=True)
+        return path
+    return path if os.path.exists(path) else filename
+
+def task_catalog():
+    # the household's chores from tasks.txt, re-read only when it changes (see chores.py)
+    return chores.load(household_file("tasks.txt"))
+
 def fetch_task_names():
-    tasks = []
-    with open("tasks.txt", "r") as f:
-        for line in f:
-            tasks.append(line.strip())
-    return tasks
+    return [chore.name for chore in task_catalog()]
 
 def get_week_id():
     jan_4_1970 = 280800000 # jan 4 1970 in milliseconds
@@ -143,46 +638,78 @@ def get_week_id():
     weeks_since = (current_time - jan_4_1970)/1000/60/60/24/7
     return int(weeks_since)
 
-def fetch_task_obj(week, create_if_nonexistent=False):
-    tasks = WeeklyTasks.query.get(week)
-    if tasks is None:
+generate_week_lock = threading.Lock()
+
+def week_generated(week):
+    return WeeklyTasks.query.filter_by(week_id=week).first() is not None
+
+def fetch_task_obj(week, create_if_nonexistent=False, assigned_to=None):
+    if not week_generated(week):
         if create_if_nonexistent:
-            last_week_tasks = fetch_task_obj(week-1, create_if_nonexistent=False)
-            tasks = []
-            task_names = fetch_task_names()
-            for index, task_name in enumerate(task_names):
-                assigned_to = roommates[(week + index) % len(roommates)] # generate roommate
-                overdue = False
-
-                # determine if roommate is overdue for this task from last week
-                # if so, assign it to them this week as well
-                if last_week_tasks is not None:
-                    for last_week_task in last_week_tasks:
-                        if last_week_task['name'].lower() == task_name.lower():
-                            if last_week_task['completed'] == False:
-                                assigned_to = last_week_task['assigned_to']
-                                overdue = True
-                            break
-
-                # add task
-                tasks.append({'id': index, 'name': task_name, 'assigned_to': assigned_to, 'completed': False, 'overdue': overdue})
-            serialized_obj = json.dumps(tasks)
-            print("Generating new tasks. Serialized: " + serialized_obj)
-            db.session.add(WeeklyTasks(week_id=week, obj=serialized_obj))
-            db.session.commit()
-            return tasks
+            generate_week(week)
         else:
             return None
-    else:
-        return json.loads(tasks.obj)
+    query = Task.query.filter_by(week_id=week)
+    if assigned_to is not None:
+        query = query.filter_by(assigned_to=canonical_roommate_name(assigned_to))
+    return query.order_by(Task.task_id).all()
+
+def generate_week(week):
+    # safe to call from several threads/processes at once: whoever inserts the
+    # WeeklyTasks row first wins and everyone else backs off
+    with generate_week_lock:
+        if week_generated(week):
+            return
+        try:
+            # claimed before reading the history, so that's read inside the write
+            claimed = db.session.execute(sqlite_insert(WeeklyTasks).values(week_id=week).on_conflict_do_nothing()).rowcount == 1
+        except OperationalError:
+            # under WAL the loser of the race can get "database is locked" or a
+            # stale snapshot instead of a conflict. the winner is generating the
+            # week, and if it fails the next request or job run tries again.
+            claimed = False
+        if not claimed:
+            db.session.rollback()
+            return
+        catalog = task_catalog()
+        history, carryover = task_history(catalog, week)
+        generate_tasks(week, catalog, history, carryover)
+
+def task_history(catalog, week):
+    """
+    A chores.History of the weeks before week, and the chores left
+    unfinished the week right before it (chore key -> who had it). Range
+    queries over the (household_id, week_id) primary key.
+    """
+    history = chores.History(catalog)
+    carryover = {}
+    rows = db.session.query(Task.week_id, Task.name, Task.assigned_to, Task.completed).filter(Task.week_id >= week - chores.HISTORY_WEEKS, Task.week_id < week).order_by(Task.week_id)
+    for week_id, name, assigned_to, completed in rows:
+        history.record(week_id, name, assigned_to)
+        if week_id == week - 1 and not completed:
+            carryover[name.lower()] = assigned_to
+    # chores that come up less often than the balancing window still need
+    # their last week, or they'd be handed out again too early
+    lookback = max([chore.every for chore in catalog] + [chores.HISTORY_WEEKS])
+    if lookback > chores.HISTORY_WEEKS:
+        older = db.session.query(Task.name, db.func.max(Task.week_id)).filter(Task.week_id >= week - lookback, Task.week_id < week - chores.HISTORY_WEEKS).group_by(Task.name)
+        for name, week_id in older:
+            history.seen(week_id, name)
+    return history, carryover
+
+def generate_tasks(week, catalog, history, carryover):
+    for chore, assigned_to, overdue in chores.plan(catalog, get_roster().ordered_names, [week], history, carryover)[week]:
+        db.session.add(Task(week_id=week, task_id=chore.index, name=chore.name, assigned_to=assigned_to, completed=False, overdue=overdue))
+    app.logger.info("Generating new tasks for week %d in household %d.", week, current_household_id())
+    bump_version('tasks')
+    db.session.commit()
+    publish('week', {'week': week})
 
 def num_remaining_tasks(user):
-    tasks = fetch_task_obj(get_week_id(), True)
-    ntasks = 0
-    for task in tasks:
-        if not task['completed'] and task['assigned_to'].lower() == user.lower():
-            ntasks += 1
-    return ntasks
+    week = get_week_id()
+    if not week_generated(week):
+        generate_week(week)
+    return Task.query.filter_by(week_id=week, assigned_to=canonical_roommate_name(user), completed=False).count()
 
 @app.route('/task/<action>/<week>/<id>')
 @login_required
@@ -191,33 +718,77 @@ def modify_task_status(action, week, id):
         flash("Unknown action.")
         return redirect(url_for('tasks', week=week))
 
-    tasks_db = WeeklyTasks.query.get(week)
-    if tasks_db is None:
-        flash('Nonexistent week.')
+    task = Task.query.filter_by(week_id=int(week), task_id=int(id)).first()
+    if task is None:
+        if not week_generated(week):
+            flash('Nonexistent week.')
+        else:
+            flash('Nonexistent task.')
         return redirect(url_for('tasks', week=week))
-
-    tasks = json.loads(tasks_db.obj)
-    for task in tasks:
-        if task['id'] == int(id):
-            task['completed'] = True if action == "complete" else False
-            tasks_db.obj = json.dumps(tasks)
-            db.session.commit()
-            return redirect(url_for('tasks', week=week))
-    flash('Nonexistent task.')
+    task.completed = action == "complete"
+    bump_version('tasks')
+    db.session.commit()
+    publish('task', {'id': int(id), 'week': int(week), 'completed': action == "complete"})
     return redirect(url_for('tasks', week=week))
 
+@app.cli.command('migrate-tasks')
+def migrate_tasks():
+    """Move the legacy WeeklyTasks.obj json blobs into task rows."""
+    db.create_all()
+    migrated = 0
+    rows = []
+    for weekly_tasks in WeeklyTasks.query.filter(WeeklyTasks.obj != None):
+        if Task.query.filter_by(week_id=weekly_tasks.week_id).count() > 0:
+            continue
+        for task in json.loads(weekly_tasks.obj):
+            rows.append({'week_id': weekly_tasks.week_id, 'task_id': task['id'], 'name': task['name'], 'assigned_to': canonical_roommate_name(task['assigned_to']), 'completed': task['completed'], 'overdue': task['overdue']})
+        migrated += 1
+    if len(rows) > 0:
+        db.session.execute(db.insert(Task), rows)
+    bump_version('tasks')
+    db.session.commit()
+    print("Migrated %d weeks." % migrated)
+
+SCHEDULE_WEEKS = 4
+MAX_SCHEDULE_WEEKS = 26
+
 @app.route('/schedule')
+@read_only
 @login_required
 def schedule():
-    return render_template('schedule.html', tab='schedule')
+    # this week's chores as generated, then a plan for the weeks after it that
+    # assumes everything gets done on time. ?weeks=N to plan further ahead.
+    nweeks = min(max(request.args.get('weeks', SCHEDULE_WEEKS, type=int), 1), MAX_SCHEDULE_WEEKS)
+    catalog = task_catalog()
+    members = get_roster().ordered_names
+    current = get_week_id()
+    weeks = list(range(current, current + nweeks))
+    assigned = dict([(week, {}) for week in weeks])
+    if week_generated(current):
+        history, carryover = task_history(catalog, current + 1)[0], None
+        for task in Task.query.filter_by(week_id=current):
+            assigned[current][task.name.lower()] = task.assigned_to
+        planned = weeks[1:]
+    else:
+        history, carryover = task_history(catalog, current)
+        planned = weeks
+    for week, assignments in chores.plan(catalog, members, planned, history, carryover).items():
+        for chore, member, overdue in assignments:
+            assigned[week][chore.key] = member
+    weights = dict([(chore.key, chore.weight) for chore in catalog])
+    loads = dict([(member, [sum([weights.get(key, 1) for key, assignee in assigned[week].items() if assignee == member]) for week in weeks]) for member in members])
+    rows = [{'name': chore.name, 'weight': chore.weight, 'every': chore.every, 'members': [assigned[week].get(chore.key) for week in weeks]} for chore in catalog]
+    return render_template('schedule.html', tab='schedule', weeks=weeks, current=current, rows=rows, loads=loads, nweeks=nweeks, max_weeks=MAX_SCHEDULE_WEEKS)
 
 @app.route('/tasks/<week>')
 @login_required
+@conditional('tasks')
 def tasks(week):
+    show_all = "show_all" in request.args
     if week == "latest" or week == str(get_week_id()):
         latest = True
         week = get_week_id()
-        tasks = fetch_task_obj(week, True)
+        tasks = fetch_task_obj(week, True, None if show_all else current_user.name)
     else:
         try:
             week = int(week)
@@ -225,37 +796,53 @@ def tasks(week):
             abort(400)
             return
         latest = False
-        tasks = fetch_task_obj(week, False)
-    show_all = "show_all" in request.args
-    if tasks is not None and not show_all:
-        tasks = [task for task in tasks if task["assigned_to"].lower() == current_user.name.lower()]
+        tasks = fetch_task_obj(week, False, None if show_all else current_user.name)
     return render_template('tasks.html', tab='tasks', week=week, latest=latest, tasks=tasks, show_all=show_all)
 
+# detached User objects by name, so flask_login doesn't hit the database on every request
+user_cache = cache.LRUCache('users', maxsize=1024, ttl=5 * 60)
+
 @login_manager.user_loader
 def user_loader(user_id):
-    user = User.query.get(user_id)
+    user = user_cache.get(user_id)
+    if user is None:
+        user = User.query.get(user_id)
+        if user is not None:
+            db.session.expunge(user)
+            user_cache.set(user_id, user)
     return user
 
 @app.route('/groceries')
+@read_only
 @login_required
+@conditional('groceries')
 def groceries():
-    groceries = GroceryItem.query.all()
+    # expired groceries are purged by the purge-groceries background job
+    show_bought = 'show_bought' in request.args
+    grocery_list = cached_fragment(('grocery_list', current_household_id(), show_bought, get_version('groceries')), lambda: render_grocery_list(show_bought))
+    return render_template('groceries.html', tab='groceries', grocery_list=grocery_list, show_bought=show_bought)
 
-    # remove out of date groceries
-    groceries_to_remove = []
-    for grocery in groceries:
-        if grocery.recently_bought and grocery.bought_when + timedelta(weeks=1) < datetime.datetime.now():
-            # has been removed for more than a week
-            with open("grocery_log.txt", "a") as f:
-                f.write(str(grocery.id) + "," + str(grocery.name) + "," + str(grocery.quantity) + "," + str(grocery.votes) + "," + str(grocery.recently_bought) + "," + str(grocery.bought_by) + "," + str(grocery.added_when) + "," + str(grocery.bought_when) + "," + str(grocery.note) + "\n")
-            groceries_to_remove.append(grocery)
-    if len(groceries_to_remove) > 0:
-        for grocery in groceries_to_remove:
-            db.session.delete(grocery)
-        db.session.commit()
-        print("Purged old groceries.")
+def render_grocery_list(show_bought):
+    query = GroceryItem.query.options(db.selectinload(GroceryItem.voters))
+    if not show_bought:
+        query = query.filter_by(recently_bought=False)
+    groceries = query.order_by(GroceryItem.id).all()
+    return render_template('grocery_list.html', groceries=grocery_rows(groceries), show_bought=show_bought)
 
-    return render_template('groceries.html', tab='groceries', groceries=groceries, show_bought=('show_bought' in request.args))
+def grocery_rows(groceries):
+    # view model for grocery_list.html, see finance_summary_view
+    roster = get_roster()
+    for grocery in groceries:
+        yield {
+            'id': grocery.id,
+            'name': grocery.name,
+            'quantity': grocery.quantity,
+            'note': grocery.note,
+            'votes': "".join([roster.initials[vote.member_id] for vote in grocery.voters]),
+            'recently_bought': grocery.recently_bought,
+            'bought_by': capitalize(grocery.bought_by) if grocery.recently_bought else None,
+            'bought_on': time_conv(grocery.bought_when).strftime('%b %d') if grocery.recently_bought else None,
+        }
 
 @app.route('/groceries/add', methods=['GET', 'POST'])
 @login_required
@@ -268,10 +855,12 @@ def add_grocery():
         return redirect(url_for('groceries'))
     quantity = int(request.form['quantity'])
     note = request.form['note']
-    votes = strings_to_votes([current_user.name])
-    item = GroceryItem(name=name, quantity=quantity, note=note, votes=votes)
-    db.session.add(item)
+    grocery = new_grocery(name, quantity, note)
+    bump_version('groceries')
+    db.session.flush()
+    delta = grocery_json(grocery)
     db.session.commit()
+    publish('grocery', delta)
     return redirect(url_for('groceries'))
 
 @app.route('/groceries/<action>/<id>')
@@ -280,6 +869,19 @@ def modify_grocery(action, id):
     if not (action == "delete" or action == "undelete" or action == "vote"):
         return abort(400)
     grocery = GroceryItem.query.get(id)
+    modify_grocery_item(grocery, action)
+    bump_version('groceries')
+    delta = grocery_json(grocery)
+    db.session.commit()
+    publish('grocery', delta)
+    return redirect(url_for('groceries'))
+
+def new_grocery(name, quantity, note):
+    item = GroceryItem(name=name, quantity=quantity, note=note, voters=[GroceryVote(member_id=current_member_id())])
+    db.session.add(item)
+    return item
+
+def modify_grocery_item(grocery, action):
     if action == "undelete":
         grocery.recently_bought = False
     elif action == "delete":
@@ -287,37 +889,25 @@ def modify_grocery(action, id):
         grocery.bought_when = datetime.datetime.utcnow()
         grocery.bought_by = current_user.name
     elif action == "vote":
-        for index, roommate in enumerate(roommates):
-            if roommate.lower() == current_user.name.lower():
-                if grocery.votes & (2 ** index) != 0:
-                    grocery.votes = grocery.votes & ~(2 ** index)
-                else:
-                    grocery.votes = grocery.votes | (2 ** index)
-    db.session.commit()
-    return redirect(url_for('groceries'))
+        member_id = current_member_id()
+        votes = [vote for vote in grocery.voters if vote.member_id != member_id]
+        if len(votes) == len(grocery.voters):
+            votes.append(GroceryVote(member_id=member_id))
+        grocery.voters = votes
+
+def member_names(member_ids):
+    roster = get_roster()
+    return [roster.names[id].lower() for id in member_ids]
 
-def votes_to_strings(votes):
-    ret = []
-    for index, roommate in enumerate(roommates):
-        if votes & (2 ** index) != 0:
-            ret.append(roommate.lower())
-    return ret
-
-def votes_to_string(votes):
-    st = ""
-    for index, roommate in enumerate(roommates):
-        if votes & (2 ** index) != 0:
-            st += roommate[0].upper()
-    return st
-
-def strings_to_votes(arr):
-    votes = 0
-    for name in arr:
-        for index, roommate in enumerate(roommates):
-            if roommate.lower() == name.lower():
-                votes += 2 ** index
-                break
-    return votes
+def initials(member_ids):
+    roster = get_roster()
+    return "".join([roster.initials[id] for id in member_ids])
+
+def voter_ids(grocery):
+    return [vote.member_id for vote in grocery.voters]
+
+def beneficiary_ids(purchase):
+    return [share.roommate_id for share in purchase.shares]
 
 def capitalize(st):
     if len(st) >= 1:
@@ -326,41 +916,292 @@ def capitalize(st):
         return st
 
 def get_roommate_name(id):
-    return roommates[id]
+    return get_roster().names[id]
+
+# money is kept in integer cents everywhere and only turned into dollars to
+# show it, or at the edges (forms, exports, the analytics api)
+
+MAX_CENTS = 5000 * 100 # anything bigger is most likely a typo
+
+def parse_cents(value):
+    # "12.34" -> 1234, without going through a binary float on the way
+    try:
+        cents = decimal.Decimal(str(value).strip()) * 100
+    except decimal.InvalidOperation:
+        cents = None
+    if cents is None or not cents.is_finite():
+        raise ValueError("%r is not an amount of money." % (value,))
+    if cents != cents.to_integral_value():
+        raise ValueError("%r has a fraction of a cent." % (value,))
+    return int(cents)
 
-def money_format(num):
-    return locale.currency(num)
+def dollars(cents):
+    # 1234 -> "12.34", for form fields and links
+    return "%s%d.%02d" % ('-' if cents < 0 else '', abs(cents) // 100, abs(cents) % 100)
+
+def make_money_format():
+    # locale.currency looks up localeconv() on every call. for locales that
+    # write the sign, then the symbol, then the number (like en_US), format
+    # with the conventions read once instead. the result is the same string.
+    conv = locale.localeconv()
+    layout = (conv['p_cs_precedes'], conv['n_cs_precedes'], conv['p_sep_by_space'], conv['n_sep_by_space'], conv['p_sign_posn'], conv['n_sign_posn'])
+    if layout != (1, 1, 0, 0, 1, 1) or conv['mon_decimal_point'] != '.' or conv['frac_digits'] != 2:
+        return lambda cents: locale.currency(cents / 100)
+    symbol = conv['currency_symbol']
+    positive = conv['positive_sign'] + symbol
+    negative = conv['negative_sign'] + symbol
+    def money_format(cents):
+        return (negative if cents < 0 else positive) + dollars(abs(cents))
+    return money_format
+
+money_format = make_money_format()
 
 def time_conv(time):
     return time - timedelta(hours=5)
 
+def date_field(when):
+    # some legacy purchases and transfers have no date
+    return f"{when:%Y-%m-%d}" if when else ''
+
 @app.context_processor
 def context():
-    return dict(votes_to_string=votes_to_string, capitalize=capitalize, get_roommate_name=get_roommate_name, money_format=money_format, time_conv=time_conv, get_roommate_id=get_roommate_id, roommates=roommates)
+    # per-row lookups and formatting happen in the view models (finance_summary_view etc.)
+    return dict(capitalize=capitalize, time_conv=time_conv, roommates=get_roster().ordered_names)
 
 def get_roommate_id(st):
-    for id, roommate in enumerate(roommates):
-        if roommate.lower() == st.lower():
-            return id
-    return None
+    return get_roster().ids_by_name.get(st.lower())
+
+def current_member_id():
+    return get_roommate_id(current_user.name)
+
+def canonical_roommate_name(st):
+    id = get_roommate_id(st)
+    return get_roster().names[id] if id is not None else st
+
+class Roster:
+    """A household's members in display order, with lookups both ways."""
+
+    def __init__(self, members):
+        # members is a list of (id, name)
+        self.ids = [id for id, name in members]
+        self.names = dict(members)
+        self.ids_by_name = dict([(name.lower(), id) for id, name in members])
+        self.ordered_names = [name for id, name in members]
+        self.initials = dict([(id, name[0].upper()) for id, name in members])
+
+    def __len__(self):
+        return len(self.ids)
+
+# (household id, members version) -> Roster
+roster_cache = cache.LRUCache('rosters', maxsize=1024)
+
+def get_roster(household_id=None):
+    # loaded once per members version and remembered for the rest of the request
+    if household_id is None:
+        household_id = current_household_id()
+    if has_request_context() and household_id in g.setdefault('rosters', {}):
+        return g.rosters[household_id]
+    key = (household_id, get_version('members', household_id))
+    roster = roster_cache.get(key)
+    if roster is None:
+        roster = Roster(db.session.query(Member.id, Member.name).filter_by(household_id=household_id).order_by(Member.id).all())
+        roster_cache.set(key, roster)
+    if has_request_context():
+        g.rosters[household_id] = roster
+    return roster
 
-def calc_totals(purchase):
+def split_cents(total, nways):
+    # first (total % nways) people pay one extra cent so the shares always add up
+    base, remainder = divmod(total, nways)
+    return [base + 1 if i < remainder else base for i in range(nways)]
+
+def calc_totals(purchase, beneficiaries):
+    # beneficiaries is a list of member ids
     if purchase.split_mode == 'even':
-        totals = []
-        npeople = 0
-        for index, roommate in enumerate(roommates):
-            if purchase.bought_for & (2 ** index) != 0:
-                totals.append(purchase.price)
-                npeople += 1
-            else:
-                totals.append(0)
-        for i in range(len(totals)):
-            totals[i] = totals[i]/npeople
-        purchase.totals = ",".join([str(x) for x in totals])
+        amounts = split_cents(purchase.price_cents, len(beneficiaries))
+        purchase.shares = [PurchaseShare(roommate_id=id, share=amt) for id, amt in zip(beneficiaries, amounts)]
     else:
         raise("Unknown mode.")
 
+def form_beneficiaries():
+    # member ids ticked in the buying_for_<name> checkboxes
+    roster = get_roster()
+    return [id for id in roster.ids if 'buying_for_' + roster.names[id].lower() in request.form]
+
+def shares_string(purchase):
+    return ", ".join(["%s: %s" % (get_roommate_name(share.roommate_id), money_format(share.share)) for share in purchase.shares])
+
+@app.cli.command('migrate-shares')
+def migrate_shares():
+    """Move the legacy Purchase.totals strings into purchase_share rows."""
+    db.create_all()
+    migrated = 0
+    rows = []
+    mismatched = 0
+    purchases = Purchase.query.filter(Purchase.totals != None, ~Purchase.shares.any()).execution_options(include_deleted=True)
+    for purchase in purchases:
+        # the old totals are price / people as floats, like 3.3333333333333335
+        shares = [int((decimal.Decimal(amt.strip()) * 100).quantize(decimal.Decimal(1), rounding=decimal.ROUND_HALF_UP)) for amt in purchase.totals.split(",")]
+        price_cents = purchase.price_cents if purchase.price_cents is not None else legacy_cents(purchase.price)
+        remainder = price_cents - sum(shares) if price_cents is not None else 0
+        if remainder != 0 and abs(remainder) < len([cents for cents in shares if cents != 0]):
+            # rounding each share on its own can leave the total a cent or two
+            # off the price, so the (first) biggest share takes the difference
+            biggest = shares.index(max(shares))
+            shares[biggest] += remainder
+        elif remainder != 0:
+            mismatched += 1
+            print("Purchase %d: shares add up to %s but the price is %s, left as they were." % (purchase.id, dollars(sum(shares)), dollars(price_cents)))
+        for index, cents in enumerate(shares):
+            if cents != 0:
+                rows.append({'purchase_id': purchase.id, 'roommate_id': index, 'share': cents})
+        migrated += 1
+    if len(rows) > 0:
+        db.session.execute(db.insert(PurchaseShare), rows)
+    bump_version('finance')
+    db.session.commit()
+    print("Migrated %d purchases, %d with shares that don't add up to the price." % (migrated, mismatched))
+
+@app.cli.command('migrate-members')
+def migrate_members():
+    """Create the first household from roommates and move the legacy bitmasks into shares and grocery votes."""
+    db.create_all()
+    if db.session.get(Household, DEFAULT_HOUSEHOLD_ID) is None:
+        db.session.add(Household(id=DEFAULT_HOUSEHOLD_ID, name='Home'))
+        db.session.flush()
+        # ids are the old bitmask positions, which every existing row already uses
+        db.session.execute(db.insert(Member), [{'id': index, 'household_id': DEFAULT_HOUSEHOLD_ID, 'name': name} for index, name in enumerate(roommates)])
+    vote_rows = []
+    for grocery_id, votes in db.session.query(GroceryItem.id, GroceryItem.votes).filter(GroceryItem.votes > 0, ~GroceryItem.voters.any()):
+        for index in range(len(roommates)):
+            if votes & (2 ** index) != 0:
+                vote_rows.append({'grocery_id': grocery_id, 'member_id': index})
+    if len(vote_rows) > 0:
+        db.session.execute(db.insert(GroceryVote), vote_rows)
+    # beneficiaries with a zero share never got a share row from migrate-shares
+    share_rows = []
+    for purchase_id, bought_for in db.session.query(Purchase.id, Purchase.bought_for).filter(Purchase.bought_for > 0).execution_options(include_deleted=True):
+        for index in range(len(roommates)):
+            if bought_for & (2 ** index) != 0:
+                share_rows.append({'purchase_id': purchase_id, 'roommate_id': index, 'share': 0})
+    if len(share_rows) > 0:
+        db.session.execute(sqlite_insert(PurchaseShare).on_conflict_do_nothing(), share_rows)
+    for version in ('members', 'finance', 'groceries', 'tasks'):
+        bump_version(version)
+    db.session.commit()
+    print("Migrated %d grocery votes." % len(vote_rows))
+
+HOUSEHOLD_TABLES = ['grocery', 'receipt', 'purchase', 'money_transfer', 'balance', 'spending_rollup', 'user']
+OLD_INDEXES = ['ix_grocery_bought', 'ix_purchase_history', 'ix_money_transfer_history', 'ix_spending_rollup_series', 'ix_purchase_household_history', 'ix_money_transfer_household_history']
+
+@app.cli.command('migrate-households')
+def migrate_households():
+    """Add household ids to an existing database. Everything goes to the first household."""
+    db.create_all()
+    # the indexes created at the end cover columns from every other upgrade too
+    add_missing_columns()
+    inspector = sqlalchemy.inspect(db.engine)
+    with db.engine.begin() as connection:
+        for table in HOUSEHOLD_TABLES:
+            if 'household_id' not in [column['name'] for column in inspector.get_columns(table)]:
+                connection.exec_driver_sql('ALTER TABLE "%s" ADD COLUMN household_id INTEGER NOT NULL DEFAULT %d' % (table, DEFAULT_HOUSEHOLD_ID))
+            else:
+                # init-db may have added it as a nullable column already
+                connection.exec_driver_sql('UPDATE "%s" SET household_id = %d WHERE household_id IS NULL' % (table, DEFAULT_HOUSEHOLD_ID))
+        # weeks and tasks are keyed by household now, which sqlite can only do by rebuilding the table
+        if 'household_id' not in inspector.get_pk_constraint('weekly_tasks')['constrained_columns']:
+            connection.exec_driver_sql('ALTER TABLE task RENAME TO task_old')
+            connection.exec_driver_sql('ALTER TABLE weekly_tasks RENAME TO weekly_tasks_old')
+            # indexes follow a renamed table. on a database that never had a task
+            # table, create_all above just made it, new indexes and all.
+            for index in list(Task.__table__.indexes) + list(WeeklyTasks.__table__.indexes):
+                connection.exec_driver_sql('DROP INDEX IF EXISTS %s' % index.name)
+            WeeklyTasks.__table__.create(connection)
+            Task.__table__.create(connection)
+            connection.exec_driver_sql('INSERT INTO weekly_tasks (household_id, week_id, obj) SELECT %d, week_id, obj FROM weekly_tasks_old' % DEFAULT_HOUSEHOLD_ID)
+            connection.exec_driver_sql('INSERT INTO task (household_id, week_id, task_id, name, assigned_to, completed, overdue) SELECT %d, week_id, task_id, name, assigned_to, completed, overdue FROM task_old' % DEFAULT_HOUSEHOLD_ID)
+            connection.exec_driver_sql('DROP TABLE task_old')
+            connection.exec_driver_sql('DROP TABLE weekly_tasks_old')
+        # versions are per household now
+        connection.exec_driver_sql("UPDATE data_version SET name = name || ':%d' WHERE name NOT LIKE '%%:%%'" % DEFAULT_HOUSEHOLD_ID)
+        for index in OLD_INDEXES:
+            connection.exec_driver_sql('DROP INDEX IF EXISTS %s' % index)
+        for table in db.metadata.sorted_tables:
+            for index in table.indexes:
+                connection.execute(sqlalchemy.schema.CreateIndex(index, if_not_exists=True))
+    print("Migrated to households.")
+
+@app.cli.command('migrate-cents')
+def migrate_cents():
+    """Move the legacy float prices and amounts into integer cents and rebuild the ledger in cents."""
+    db.create_all()
+    add_missing_columns()
+    convert_to_cents()
+    with db.engine.begin() as connection:
+        # the ledger only holds derived totals, so it's rebuilt in cents instead of converted
+        Balance.__table__.drop(connection)
+        Balance.__table__.create(connection)
+    for household_id in household_ids():
+        with in_household(household_id):
+            write_ledger(calc_owes_from_history())
+    print("Ledger rebuilt in cents.")
+
+def legacy_cents(value):
+    # the old float dollar columns
+    return int(round(value * 100)) if value is not None else None
+
+def convert_to_cents():
+    # only touches rows whose cents are still empty, so init-db runs it on every upgrade
+    with db.engine.begin() as connection:
+        for table, legacy, column in [(Purchase.__table__, 'price', 'price_cents'), (MoneyTransfer.__table__, 'amount', 'amount_cents')]:
+            rows = [{'row_id': id, 'cents': legacy_cents(value)} for id, value in connection.execute(db.select(table.c.id, table.c[legacy]).where(table.c[column] == None, table.c[legacy] != None))]
+            if len(rows) > 0:
+                connection.execute(table.update().where(table.c.id == sqlalchemy.bindparam('row_id')).values({column: sqlalchemy.bindparam('cents')}), rows)
+                print("Converted %d %s rows." % (len(rows), table.name))
+
+def empty_float_ledger():
+    # a ledger from before cents can't be converted in place. it's emptied
+    # here and filled again in cents by fill_derived_tables.
+    amount = [column for column in sqlalchemy.inspect(db.engine).get_columns('balance') if column['name'] == 'amount'][0]
+    if isinstance(amount['type'], sqlalchemy.Integer):
+        return
+    with db.engine.begin() as connection:
+        Balance.__table__.drop(connection)
+        Balance.__table__.create(connection)
+    print("Emptied the ledger to rebuild it in cents.")
+
+@app.cli.command('add-household')
+@click.argument('name')
+def add_household(name):
+    """Create an empty household."""
+    household = Household(name=name)
+    db.session.add(household)
+    db.session.commit()
+    print("Created household %d." % household.id)
+
+@app.cli.command('add-member')
+@click.argument('name')
+@click.option('--password', help='Also create a login for them.')
+@household_option
+def add_member(name, password):
+    """Add someone to a household."""
+    if get_roommate_id(name) is not None:
+        print("%s is already a member." % name)
+        return
+    if password is not None and db.session.get(User, name) is not None:
+        print("Someone already logs in as %s." % name)
+        return
+    db.session.add(Member(household_id=current_household_id(), name=name))
+    if password is not None:
+        db.session.add(User(name=name, password=password, household_id=current_household_id()))
+    # every page lists members, so nothing cached before this is current
+    for version in ('members', 'finance', 'groceries', 'tasks'):
+        bump_version(version)
+    db.session.commit()
+    print("Added %s." % name)
+
 @app.route('/owes')
+@read_only
 @login_required
 def show_owes():
     return str(calc_owes())
@@ -369,35 +1210,87 @@ def show_owes():
 @login_required
 def add_purchase():
     if request.method == 'GET':
-        return render_template('new_purchase.html', tab='finance', date=f"{datetime.datetime.now():%Y-%m-%d}", spending_types=spending_types, roommates=roommates)
+        return render_template('new_purchase.html', tab='finance', date=f"{datetime.datetime.now():%Y-%m-%d}", spending_types=spending_types)
     elif request.method == 'POST':
         name = request.form['name']
         bought_when = datetime.datetime.strptime(request.form['bought_when'], '%Y-%m-%d')
         bought_by = get_roommate_id(request.form['bought_by'])
-        bought_for = []
-        for roommate in roommates:
-            if 'buying_for_' + roommate.lower() in request.form:
-                bought_for.append(roommate)
-        bought_for = strings_to_votes(bought_for)
-        assert(bought_for > 0)
+        bought_for = form_beneficiaries()
+        assert(len(bought_for) > 0)
         spending_type = request.form['spending_type']
         assert(spending_type.lower() in spending_types)
-        price = float(request.form['price'])
-        assert(price >= 0 and price < 5000)
+        price_cents = parse_cents(request.form['price'])
+        assert(price_cents >= 0 and price_cents < MAX_CENTS)
         split_mode = request.form['split_mode']
         additional_info = request.form['additional_info']
-        purchase = Purchase(name=name, bought_when=bought_when, bought_by=bought_by, bought_for=bought_for, spending_type=spending_type, price=price, split_mode=split_mode, additional_info=additional_info)
-        calc_totals(purchase)
+        try:
+            receipt = upload_receipt()
+        except ValueError as e:
+            flash(str(e))
+            return redirect(url_for('add_purchase'))
+        purchase = Purchase(name=name, bought_when=bought_when, bought_by=bought_by, spending_type=spending_type, price_cents=price_cents, split_mode=split_mode, additional_info=additional_info)
+        if receipt is not None:
+            purchase.receipt_id = receipt.id
+        calc_totals(purchase, bought_for)
         db.session.add(purchase)
+        db.session.flush()
+        bump_version('finance')
+        apply_purchase(purchase)
         db.session.commit()
+        queue_receipt(receipt)
         flash("Successfully added.")
         return redirect(url_for('finance'))
 
+PAGE_SIZE = 50
+
+# undated legacy rows sort, and page, by when they were entered
+PURCHASE_HISTORY = (db.func.coalesce(Purchase.bought_when, Purchase.added_when), Purchase.added_when, Purchase.id)
+TRANSFER_HISTORY = (db.func.coalesce(MoneyTransfer.transferred_when, MoneyTransfer.added_when), MoneyTransfer.added_when, MoneyTransfer.id)
+
+def encode_cursor(values):
+    return ",".join([str(value.isoformat()) if isinstance(value, datetime.datetime) else str(value) for value in values])
+
+def decode_cursor(cursor):
+    when, added_when, id = cursor.split(",")
+    return datetime.datetime.fromisoformat(when), datetime.datetime.fromisoformat(added_when), int(id)
+
+def paginate_history(query, columns):
+    # keyset pagination over (when, added_when, id), newest first.
+    # ?after=<cursor> continues from the last row of the previous page.
+    query = query.order_by(*[column.desc() for column in columns])
+    if 'after' in request.args:
+        try:
+            cursor = decode_cursor(request.args['after'])
+        except ValueError:
+            abort(400)
+        query = query.filter(db.tuple_(*columns) < cursor)
+    # the sort columns come back alongside each row, since the first is an expression
+    rows = query.add_columns(*columns).limit(PAGE_SIZE + 1).all()
+    next_cursor = None
+    if len(rows) > PAGE_SIZE:
+        rows = rows[:PAGE_SIZE]
+        next_cursor = encode_cursor(rows[-1][1:])
+    return [row[0] for row in rows], next_cursor
+
+def stream_history(template_name, rows_name, query, columns, view, **context):
+    # renders every row without materializing the table, for ?stream. view
+    # turns the rows into what the template shows, see purchase_rows.
+    context[rows_name] = view(query.order_by(*[column.desc() for column in columns]).yield_per(PAGE_SIZE))
+    app.update_template_context(context)
+    template = app.jinja_env.get_template(template_name)
+    return Response(stream_with_context(template.generate(context)))
+
 @app.route('/purchase/view/<id>')
+@read_only
 @login_required
 def view_purchase(id):
     if id == "all":
-        return render_template("view_all_purchases.html", tab="finance", purchases=Purchase.query.order_by(Purchase.bought_when.desc(), Purchase.added_when.desc()).all())
+        columns = PURCHASE_HISTORY
+        query = Purchase.query.options(db.selectinload(Purchase.shares))
+        if 'stream' in request.args:
+            return stream_history("view_all_purchases.html", "purchases", query, columns, purchase_rows, tab="finance", next_cursor=None)
+        purchases, next_cursor = paginate_history(query, columns)
+        return render_template("view_all_purchases.html", tab="finance", purchases=purchase_rows(purchases), next_cursor=next_cursor)
     else:
         purchase = Purchase.query.get(int(id))
         if purchase == None:
@@ -409,16 +1302,16 @@ def view_purchase(id):
             'added_when': purchase.added_when,
             'additional_info': purchase.additional_info,
             'split_mode': purchase.split_mode,
-            'price': purchase.price,
-            'bought_for': ", ".join([capitalize(x) for x in votes_to_strings(purchase.bought_for)]),
-            'bought_when': f"{purchase.bought_when:%Y-%m-%d}",
-            'receipt_id': purchase.receipt_id,
-            'totals': purchase.totals,
+            'price': money_format(purchase.price_cents),
+            'bought_for': ", ".join([capitalize(x) for x in member_names(beneficiary_ids(purchase))]),
+            'bought_when': date_field(purchase.bought_when),
+            'totals': shares_string(purchase),
             'spending_type': purchase.spending_type,
         }
-        return render_template('view_purchase.html', tab='finance', purchase=data, id=id)
+        return render_template('view_purchase.html', tab='finance', purchase=data, id=id, receipt=get_receipt(purchase.receipt_id))
 
 @app.route('/purchase/edit/<id>', methods=['GET', 'POST'])
+@read_only
 @login_required
 def edit_purchase(id):
     purchase = Purchase.query.get(id)
@@ -428,48 +1321,55 @@ def edit_purchase(id):
             'bought_by': get_roommate_name(purchase.bought_by),
             'additional_info': purchase.additional_info,
             'split_mode': purchase.split_mode,
-            'price': purchase.price,
-            'bought_for': votes_to_strings(purchase.bought_for),
-            'bought_when': f"{purchase.bought_when:%Y-%m-%d}",
-            'totals': purchase.totals,
+            'price': dollars(purchase.price_cents),
+            'bought_for': member_names(beneficiary_ids(purchase)),
+            'bought_when': date_field(purchase.bought_when),
+            'totals': shares_string(purchase),
             'spending_type': purchase.spending_type,
         }
-        return render_template('edit_purchase.html', tab='finance', data=data, can_delete=(data['bought_by'].lower() == current_user.name.lower()), id=id, roommates=roommates, spending_types=spending_types)
+        return render_template('edit_purchase.html', tab='finance', data=data, can_delete=(data['bought_by'].lower() == current_user.name.lower()), id=id, spending_types=spending_types, receipt=get_receipt(purchase.receipt_id))
     else:
         if 'save' in request.form:
             name = request.form['name']
             bought_when = datetime.datetime.strptime(request.form['bought_when'], '%Y-%m-%d')
             bought_by = get_roommate_id(request.form['bought_by'])
-            bought_for = []
-            for roommate in roommates:
-                if 'buying_for_' + roommate.lower() in request.form:
-                    bought_for.append(roommate)
-            bought_for = strings_to_votes(bought_for)
-            assert(bought_for > 0)
+            bought_for = form_beneficiaries()
+            assert(len(bought_for) > 0)
             spending_type = request.form['spending_type']
             assert(spending_type.lower() in spending_types)
-            price = float(request.form['price'])
-            assert(price >= 0 and price < 5000)
+            price_cents = parse_cents(request.form['price'])
+            assert(price_cents >= 0 and price_cents < MAX_CENTS)
             split_mode = request.form['split_mode']
             additional_info = request.form['additional_info']
+            try:
+                receipt = upload_receipt()
+            except ValueError as e:
+                flash(str(e))
+                return redirect(url_for('edit_purchase', id=id))
 
+            apply_purchase(purchase, -1)
             purchase.name = name
             purchase.bought_when = bought_when
-            purchase.bought_for = bought_for
             purchase.spending_type = spending_type
-            purchase.price = price
+            purchase.price_cents = price_cents
             purchase.split_mode = split_mode
             purchase.additional_info = additional_info
-            calc_totals(purchase)
+            if receipt is not None:
+                purchase.receipt_id = receipt.id
+            calc_totals(purchase, bought_for)
+            bump_version('finance')
+            apply_purchase(purchase)
             db.session.commit()
+            queue_receipt(receipt)
             flash("Saved successfully.")
             return redirect(url_for('view_purchase', id=id))
         elif 'delete' in request.form:
-            print("TODO log deletion and save copy of deleted purchase.")
             if get_roommate_name(purchase.bought_by).lower() == current_user.name.lower():
-                db.session.delete(purchase)
+                apply_purchase(purchase, -1)
+                bump_version('finance')
+                purchase.deleted_when = datetime.datetime.utcnow()
                 db.session.commit()
-                flash("Deleted purchase id %s, '%s'." % (purchase.id, purchase.name))
+                flash("Deleted purchase id %s, '%s'. You can restore it from the recently deleted list." % (purchase.id, purchase.name))
                 return redirect(url_for('finance', id=id))
             else:
                 flash("You can only delete your own purchases.")
@@ -477,6 +1377,76 @@ def edit_purchase(id):
         else:
             return abort(400)
 
+receipt_pool = ThreadPoolExecutor(max_workers=app.config['RECEIPT_WORKERS'], thread_name_prefix='receipts')
+metrics.describe('groomsgang_receipt_seconds', 'Time spent processing a receipt, by outcome.')
+
+def upload_receipt():
+    # stores the file from the receipt field, if one was picked, and returns
+    # its Receipt. uploading the same file again reuses the existing one.
+    upload = request.files.get('receipt')
+    if upload is None or upload.filename == '':
+        return None
+    digest, content_type, size = receipts.store(upload.stream, app.config['RECEIPT_DIR'], app.config['RECEIPT_MAX_BYTES'])
+    receipt = Receipt.query.filter_by(sha256=digest).first()
+    if receipt is None:
+        receipt = Receipt(sha256=digest, content_type=content_type, size=size, image_file=receipts.relative_path(digest))
+        db.session.add(receipt)
+        db.session.flush()
+    return receipt
+
+def get_receipt(id):
+    if id is None or id < 0:
+        return None
+    return Receipt.query.get(id)
+
+def queue_receipt(receipt):
+    # call after committing, so the worker can see the row
+    if receipt is not None and receipt.status == 'pending':
+        receipt_pool.submit(process_receipt, receipt.id, receipt.household_id)
+
+def process_receipt(id, household_id):
+    with app.app_context(), in_household(household_id):
+        receipt = Receipt.query.get(id)
+        if receipt is None or receipt.status != 'pending':
+            return
+        start = time.perf_counter()
+        try:
+            details, has_thumbnail = receipts.process(app.config['RECEIPT_DIR'], receipt.sha256, receipt.content_type)
+            receipt.itemdata = json.dumps(details)
+            receipt.has_thumbnail = has_thumbnail
+            receipt.status = 'ready'
+        except Exception:
+            traceback.print_exc()
+            receipt.status = 'failed'
+        db.session.commit()
+        metrics.observe('groomsgang_receipt_seconds', {'status': receipt.status}, time.perf_counter() - start)
+
+def send_receipt_file(path, mimetype):
+    # the url of a receipt always serves the same bytes, so browsers can keep it
+    response = send_file(os.path.abspath(os.path.join(app.config['RECEIPT_DIR'], path)), mimetype=mimetype, max_age=app.config['RECEIPT_MAX_AGE'], conditional=True)
+    response.cache_control.public = False
+    response.cache_control.private = True
+    response.cache_control.immutable = True
+    return response
+
+@app.route('/receipt/<int:id>')
+@read_only
+@login_required
+def view_receipt(id):
+    receipt = get_receipt(id)
+    if receipt is None:
+        return abort(404)
+    return send_receipt_file(receipt.image_file, receipt.content_type)
+
+@app.route('/receipt/<int:id>/thumbnail')
+@read_only
+@login_required
+def receipt_thumbnail(id):
+    receipt = get_receipt(id)
+    if receipt is None or not receipt.has_thumbnail:
+        return abort(404)
+    return send_receipt_file(receipts.thumbnail_relative_path(receipt.sha256), 'image/jpeg')
+
 @app.route('/addusers')
 def addusers():
     """
@@ -502,12 +1472,18 @@ def addusers():
 @login_required
 def add_moneytransfer():
     if request.method == 'GET':
-        return render_template('new_moneytransfer.html', date=f"{datetime.datetime.now():%Y-%m-%d}", tab='finance', roommates=roommates, methods=payment_methods)
+        draft = {
+            'name': request.args.get('name', ''),
+            'who_paid': request.args.get('who_paid', current_user.name).lower(),
+            'to_whom': request.args.get('to_whom', '').lower(),
+            'amount': request.args.get('amount', ''),
+        }
+        return render_template('new_moneytransfer.html', date=f"{datetime.datetime.now():%Y-%m-%d}", tab='finance', methods=payment_methods, draft=draft)
     else:
         name = request.form["name"]
         try:
-            amount = float(request.form["amount"])
-        except:
+            amount_cents = parse_cents(request.form["amount"])
+        except ValueError:
             flash("Error parsing amount.")
             return redirect(url_for("add_moneytransfer"))
         additional_info = request.form["additional_info"]
@@ -520,10 +1496,10 @@ def add_moneytransfer():
         if to_whom == who_paid:
             flash("Can't pay yourself.")
             return redirect(url_for("add_moneytransfer"))
-        if amount <= 0:
+        if amount_cents <= 0:
             flash("Must pay a positive amount of money.")
             return redirect(url_for("add_moneytransfer"))
-        if amount > 5000:
+        if amount_cents > MAX_CENTS:
             flash("Too much money. Check for typos.")
             return redirect(url_for("add_moneytransfer"))
         try:
@@ -532,49 +1508,396 @@ def add_moneytransfer():
             flash("Could not parse date.")
             return redirect(url_for("add_moneytransfer"))
 
-        mtransfer = MoneyTransfer(name=name, amount=amount, additional_info=additional_info, method=method, to_whom=to_whom, who_paid=who_paid, transferred_when=transferred_when)
+        mtransfer = MoneyTransfer(name=name, amount_cents=amount_cents, additional_info=additional_info, method=method, to_whom=to_whom, who_paid=who_paid, transferred_when=transferred_when)
         db.session.add(mtransfer)
+        bump_version('finance')
+        apply_to_ledger(transfer_contributions(mtransfer))
         db.session.commit()
         flash("Added.")
         return redirect(url_for("finance"))
 
-def calc_owes():
-    purchases = Purchase.query.all()
-    money_transfers = MoneyTransfer.query.all()
+def purchase_contributions(purchase):
+    # (debtor, creditor, cents) triples this purchase adds to the owes matrix
+    contributions = []
+    for share in purchase.shares:
+        if share.roommate_id != purchase.bought_by and share.share != 0:
+            contributions.append((share.roommate_id, purchase.bought_by, share.share))
+    return contributions
 
-    #owes[a][b] is how much a owes to b
-    owes = []
-    for roommate in roommates:
-        owes.append([0] * len(roommates))
-    for purchase in purchases:
-        totals = [float(x) for x in purchase.totals.split(",")]
-        for index, amt in enumerate(totals):
-            owes[index][purchase.bought_by] += amt
-    for money_transfer in money_transfers:
-        owes[money_transfer.to_whom][money_transfer.who_paid] += money_transfer.amount
-    for who_owes in range(len(roommates)):
-        for who_is_owed in range(len(roommates)):
+def transfer_contributions(money_transfer):
+    return [(money_transfer.to_whom, money_transfer.who_paid, money_transfer.amount_cents)]
+
+def apply_to_ledger(contributions, sign=1):
+    # runs in the caller's transaction, so the ledger commits (or rolls back)
+    # together with the purchase/transfer that changed it
+    for debtor, creditor, cents in contributions:
+        db.session.execute(sqlite_insert(Balance).values(debtor=debtor, creditor=creditor, amount=0).on_conflict_do_nothing())
+        db.session.execute(db.update(Balance).where(Balance.debtor == debtor, Balance.creditor == creditor).values(amount=Balance.amount + sign * cents))
+
+def empty_owes():
+    # owes[debtor][creditor] for every pair of member ids
+    ids = get_roster().ids
+    return dict([(debtor, dict.fromkeys(ids, 0)) for debtor in ids])
+
+def calc_owes_from_history():
+    # sums every purchase and transfer in sql, in cents. only used to rebuild/verify the ledger.
+    owes = empty_owes()
+    purchase_rows = db.session.query(PurchaseShare.roommate_id, Purchase.bought_by, db.func.sum(PurchaseShare.share)) \
+        .join(Purchase, Purchase.id == PurchaseShare.purchase_id) \
+        .filter(PurchaseShare.roommate_id != Purchase.bought_by) \
+        .group_by(PurchaseShare.roommate_id, Purchase.bought_by)
+    for debtor, creditor, total in purchase_rows:
+        owes[debtor][creditor] += total
+    transfer_rows = db.session.query(MoneyTransfer.to_whom, MoneyTransfer.who_paid, db.func.sum(MoneyTransfer.amount_cents)) \
+        .group_by(MoneyTransfer.to_whom, MoneyTransfer.who_paid)
+    for debtor, creditor, total in transfer_rows:
+        owes[debtor][creditor] += total
+    return owes
+
+def read_ledger():
+    owes = empty_owes()
+    for debtor, creditor, cents in db.session.query(Balance.debtor, Balance.creditor, Balance.amount):
+        owes[debtor][creditor] = cents
+    return owes
+
+def net_owes(owes):
+    for who_owes in owes:
+        for who_is_owed in owes:
             if who_owes != who_is_owed:
                 # in case two people owe each other money, subtract out the minimum
                 amt_to_subtract = min(owes[who_owes][who_is_owed], owes[who_is_owed][who_owes])
                 owes[who_owes][who_is_owed] -= amt_to_subtract
                 owes[who_is_owed][who_owes] -= amt_to_subtract
-
     return owes
 
+def calc_owes():
+    #owes[a][b] is how many cents a owes to b
+    return net_owes(read_ledger())
+
+def suggest_transfers():
+    # unsaved MoneyTransfer drafts that settle every debt in as few transfers as possible
+    ids = get_roster().ids
+    owes = read_ledger()
+    balances = settle.net_balances([[owes[debtor][creditor] for creditor in ids] for debtor in ids])
+    return [MoneyTransfer(name="Settling up", who_paid=ids[debtor], to_whom=ids[creditor], amount_cents=cents) for debtor, creditor, cents in settle.settle(balances)]
+
+def add_missing_columns():
+    # sqlite can add nullable columns in place. anything else needs a migrate- command.
+    inspector = sqlalchemy.inspect(db.engine)
+    with db.engine.begin() as connection:
+        for table in db.metadata.sorted_tables:
+            existing = [column['name'] for column in inspector.get_columns(table.name)]
+            for column in table.columns:
+                if column.name not in existing and column.nullable and not column.primary_key:
+                    connection.exec_driver_sql('ALTER TABLE "%s" ADD COLUMN "%s" %s' % (table.name, column.name, column.type.compile(dialect=db.engine.dialect)))
+                    print("Added %s.%s." % (table.name, column.name))
+
+@app.cli.command('init-db')
+def init_db():
+    """Create any missing tables, columns and indexes."""
+    db.create_all()
+    add_missing_columns()
+    with db.engine.begin() as connection:
+        for index in OLD_INDEXES:
+            connection.exec_driver_sql('DROP INDEX IF EXISTS %s' % index)
+        # if_not_exists rather than checkfirst, which can't reflect expression indexes
+        for table in db.metadata.sorted_tables:
+            for index in table.indexes:
+                connection.execute(sqlalchemy.schema.CreateIndex(index, if_not_exists=True))
+    convert_to_cents()
+    empty_float_ledger()
+    fill_derived_tables()
+    with db.engine.begin() as connection:
+        create_search_index(connection)
+    print("Database initialized.")
+
+def fill_derived_tables():
+    # databases from before the ledger and rollups existed start with both
+    # empty, which would show everyone at $0. they're only built from fully
+    # migrated rows, since an empty table is the only signal to fill them.
+    inspector = sqlalchemy.inspect(db.engine)
+    for table in ['purchase', 'money_transfer', 'balance', 'spending_rollup']:
+        if 'household_id' not in [column['name'] for column in inspector.get_columns(table)]:
+            print("Not filling the ledger or rollups until migrate-households has run.")
+            return
+    unmigrated = db.session.query(Purchase.id).filter(Purchase.totals != None, ~Purchase.shares.any()).execution_options(all_households=True).first() is not None
+    if unmigrated:
+        print("Not filling the ledger or rollups until migrate-shares has run.")
+        return
+    for household_id in household_ids():
+        with in_household(household_id):
+            has_purchases = db.session.query(Purchase.id).first() is not None
+            if db.session.query(Balance.debtor).first() is None and (has_purchases or db.session.query(MoneyTransfer.id).first() is not None):
+                print("Household %d: filling the ledger." % household_id)
+                write_ledger(calc_owes_from_history())
+            if db.session.query(SpendingRollup.period).first() is None and has_purchases:
+                print("Household %d: filling the rollups." % household_id)
+                rebuild_household_rollups()
+
+@app.cli.command('compile-templates')
+def compile_templates():
+    """Compile every template into TEMPLATE_CACHE_DIR ahead of time."""
+    names = app.jinja_env.list_templates()
+    for name in names:
+        app.jinja_env.get_template(name)
+    print("Compiled %d templates." % len(names))
+
+def household_ids(only=None):
+    if only is not None:
+        return [only]
+    return [id for (id,) in db.session.query(Household.id).order_by(Household.id)]
+
+@app.cli.command('rebuild-balances')
+@click.option('--verify', is_flag=True, help='Only report drift, do not rewrite the ledger.')
+@click.option('--household', type=int, help='Only this household (default: all of them).')
+def rebuild_balances(verify, household):
+    """Recompute the balance ledger from the full purchase/transfer history."""
+    db.create_all()
+    for household_id in household_ids(household):
+        with in_household(household_id):
+            print("Household %d:" % household_id)
+            rebuild_household_balances(verify)
+
+def rebuild_household_balances(verify):
+    expected = calc_owes_from_history()
+    stored = read_ledger()
+    drift = 0
+    for debtor in expected:
+        for creditor in expected:
+            if stored[debtor][creditor] != expected[debtor][creditor]:
+                drift += 1
+                print("%s owes %s: ledger has %s, history has %s" % (get_roommate_name(debtor), get_roommate_name(creditor), dollars(stored[debtor][creditor]), dollars(expected[debtor][creditor])))
+    print("%d drifted cells." % drift)
+    if not verify:
+        write_ledger(expected)
+        print("Ledger rebuilt.")
+
+def write_ledger(owes):
+    Balance.query.delete()
+    for debtor in owes:
+        for creditor in owes:
+            if debtor != creditor and owes[debtor][creditor] != 0:
+                db.session.add(Balance(debtor=debtor, creditor=creditor, amount=owes[debtor][creditor]))
+    bump_version('finance')
+    db.session.commit()
+
+ROLLUP_PERIODS = ['day', 'week', 'month']
+
+def period_start(period, when):
+    day = when.date() if isinstance(when, datetime.datetime) else when
+    if period == 'week':
+        return day - timedelta(days=day.weekday())
+    elif period == 'month':
+        return day.replace(day=1)
+    return day
+
+def add_rollup_deltas(deltas, when, spending_type, bought_by, shares, sign=1):
+    # shares is a list of (roommate id, cents). the payer is credited with the
+    # whole price, each beneficiary with their share. undated purchases have
+    # no period to go in.
+    if when is None:
+        return deltas
+    for period in ROLLUP_PERIODS:
+        start = period_start(period, when)
+        key = (period, start, spending_type, bought_by, 'payer')
+        deltas[key] = deltas.get(key, 0) + sign * sum([cents for roommate_id, cents in shares])
+        for roommate_id, cents in shares:
+            key = (period, start, spending_type, roommate_id, 'beneficiary')
+            deltas[key] = deltas.get(key, 0) + sign * cents
+    return deltas
+
+def apply_rollup_deltas(deltas):
+    for (period, start, spending_type, roommate_id, role), cents in deltas.items():
+        if cents == 0:
+            continue
+        key = {'period': period, 'period_start': start, 'spending_type': spending_type, 'roommate_id': roommate_id, 'role': role}
+        db.session.execute(sqlite_insert(SpendingRollup).values(amount=cents, **key).on_conflict_do_update(index_elements=list(key), set_={'amount': SpendingRollup.amount + cents}))
+
+def apply_purchase(purchase, sign=1):
+    # everything derived from a purchase that has to change with it
+    apply_to_ledger(purchase_contributions(purchase), sign)
+    shares = [(share.roommate_id, share.share) for share in purchase.shares]
+    apply_rollup_deltas(add_rollup_deltas({}, purchase.bought_when or purchase.added_when, purchase.spending_type, purchase.bought_by, shares, sign))
+
+@app.cli.command('rebuild-rollups')
+@click.option('--household', type=int, help='Only this household (default: all of them).')
+def rebuild_rollups(household):
+    """Recompute the spending rollups from every purchase."""
+    db.create_all()
+    for household_id in household_ids(household):
+        with in_household(household_id):
+            print("Household %d:" % household_id)
+            rebuild_household_rollups()
+
+def rebuild_household_rollups():
+    # some legacy purchases were saved without a bought_when; those count on the day they were entered
+    day = db.func.date(db.func.coalesce(Purchase.bought_when, Purchase.added_when))
+    rows = db.session.query(day, Purchase.spending_type, Purchase.bought_by, PurchaseShare.roommate_id, db.func.sum(PurchaseShare.share)) \
+        .join(PurchaseShare, PurchaseShare.purchase_id == Purchase.id) \
+        .group_by(day, Purchase.spending_type, Purchase.bought_by, PurchaseShare.roommate_id)
+    deltas = {}
+    undated = 0
+    for when, spending_type, bought_by, roommate_id, cents in rows:
+        if when is None:
+            undated += cents
+            continue
+        add_rollup_deltas(deltas, datetime.date.fromisoformat(when), spending_type, bought_by, [(roommate_id, cents)])
+    if undated != 0:
+        print("Skipped %s of purchases with no date." % money_format(undated))
+    SpendingRollup.query.delete()
+    rollup_rows = [{'period': period, 'period_start': start, 'spending_type': spending_type, 'roommate_id': roommate_id, 'role': role, 'amount': cents} for (period, start, spending_type, roommate_id, role), cents in deltas.items() if cents != 0]
+    if len(rollup_rows) > 0:
+        db.session.execute(db.insert(SpendingRollup), rollup_rows)
+    bump_version('finance')
+    db.session.commit()
+    print("Rebuilt %d rollup rows." % len(rollup_rows))
+
+def calc_spent_per_roommate():
+    # member id -> total share of all purchases, in cents
+    spent = dict.fromkeys(get_roster().ids, 0)
+    rows = db.session.query(SpendingRollup.roommate_id, db.func.sum(SpendingRollup.amount)) \
+        .filter_by(period='month', role='beneficiary') \
+        .group_by(SpendingRollup.roommate_id)
+    for roommate_id, total in rows:
+        spent[roommate_id] = total
+    return spent
+
+def analytics_filters(query):
+    # ?role=payer|beneficiary, ?roommate=<name>|all (defaults to you), ?start/?end dates
+    role = request.args.get('role', 'beneficiary')
+    if role not in ('payer', 'beneficiary'):
+        raise ApiError("role must be payer or beneficiary.")
+    query = query.filter(SpendingRollup.role == role)
+    roommate = request.args.get('roommate', current_user.name)
+    if roommate != 'all':
+        roommate_id = get_roommate_id(roommate)
+        if roommate_id is None:
+            raise ApiError("Unknown roommate %s." % roommate)
+        query = query.filter(SpendingRollup.roommate_id == roommate_id)
+    try:
+        if 'start' in request.args:
+            query = query.filter(SpendingRollup.period_start >= datetime.date.fromisoformat(request.args['start']))
+        if 'end' in request.args:
+            query = query.filter(SpendingRollup.period_start <= datetime.date.fromisoformat(request.args['end']))
+    except ValueError:
+        raise ApiError("Dates must look like 2020-01-31.")
+    return query
+
+@app.route('/api/analytics/timeseries')
+@read_only
+@login_required
+def analytics_timeseries():
+    """Spending per ?period (day, week or month) and spending type."""
+    period = request.args.get('period', 'month')
+    if period not in ROLLUP_PERIODS:
+        raise ApiError("period must be one of %s." % ", ".join(ROLLUP_PERIODS))
+    query = db.session.query(SpendingRollup.period_start, SpendingRollup.spending_type, db.func.sum(SpendingRollup.amount)).filter(SpendingRollup.period == period)
+    query = analytics_filters(query).group_by(SpendingRollup.period_start, SpendingRollup.spending_type).order_by(SpendingRollup.period_start)
+    series = {}
+    for start, spending_type, cents in query:
+        if cents != 0:
+            series.setdefault(start.isoformat(), {})[spending_type] = cents / 100
+    return jsonify(period=period, series=[{'period_start': start, 'totals': totals} for start, totals in series.items()])
+
+@app.route('/api/analytics/categories')
+@read_only
+@login_required
+def analytics_categories():
+    """Total spending per spending type."""
+    # day rows when a range is given so it can start/end mid-month
+    period = 'day' if 'start' in request.args or 'end' in request.args else 'month'
+    query = db.session.query(SpendingRollup.spending_type, db.func.sum(SpendingRollup.amount)).filter(SpendingRollup.period == period)
+    query = analytics_filters(query).group_by(SpendingRollup.spending_type).order_by(db.func.sum(SpendingRollup.amount).desc())
+    return jsonify(categories=[{'spending_type': spending_type, 'total': cents / 100} for spending_type, cents in query if cents != 0])
+
 @app.route('/finance')
+@read_only
 @login_required
+@conditional('finance')
 def finance():
-    recent_purchases = Purchase.query.order_by(Purchase.bought_when.desc(), Purchase.added_when.desc()).limit(20).all()
-    recent_moneytransfers = MoneyTransfer.query.order_by(MoneyTransfer.transferred_when.desc()).limit(10).all()
+    version = get_version('finance')
+    summary = cached_fragment(('finance_summary', current_household_id(), current_user.name.lower(), version), render_finance_summary)
+    recent = cached_fragment(('finance_recent', current_household_id(), version), render_finance_recent)
+    return render_template('finance.html', summary=summary, recent=recent, tab='finance')
+
+def render_finance_summary():
+    return render_template('finance_summary.html', **finance_summary_view())
+
+def render_finance_recent():
+    recent_purchases = Purchase.query.options(db.selectinload(Purchase.shares)).order_by(*[column.desc() for column in PURCHASE_HISTORY]).limit(20).all()
+    recent_moneytransfers = MoneyTransfer.query.order_by(*[column.desc() for column in TRANSFER_HISTORY]).limit(10).all()
+    return render_template('finance_recent.html', recent_purchases=list(purchase_rows(recent_purchases)), recent_moneytransfers=list(transfer_rows(recent_moneytransfers)))
+
+# view models: the templates below get names, initials and amounts already
+# looked up and formatted, instead of calling helpers for every cell.
+
+def finance_summary_view():
+    roster = get_roster()
+    me = current_member_id()
     owes = calc_owes()
-    return render_template('finance.html', recent_purchases=recent_purchases, recent_moneytransfers=recent_moneytransfers, owes=owes, tab='finance')
+    spent = calc_spent_per_roommate()
+    debts = []
+    for other in roster.ids:
+        if other == me:
+            continue
+        you_owe = owes[me][other] > 0
+        debts.append({
+            'name': roster.names[other],
+            'you_owe': you_owe,
+            'amount': money_format(owes[me][other] if you_owe else owes[other][me]),
+        })
+    settle_up = []
+    for transfer in suggest_transfers():
+        record_url = None
+        if transfer.who_paid == me:
+            record_url = url_for('add_moneytransfer', name=transfer.name, who_paid=roster.names[transfer.who_paid].lower(), to_whom=roster.names[transfer.to_whom].lower(), amount=dollars(transfer.amount_cents))
+        settle_up.append({
+            'who_paid': roster.names[transfer.who_paid],
+            'to_whom': roster.names[transfer.to_whom],
+            'amount': money_format(transfer.amount_cents),
+            'record_url': record_url,
+        })
+    return dict(spent=money_format(spent[me]), debts=debts, settle_up=settle_up)
+
+def purchase_rows(purchases):
+    roster = get_roster()
+    for purchase in purchases:
+        yield {
+            'id': purchase.id,
+            'name': purchase.name,
+            'bought_by': roster.names[purchase.bought_by],
+            'price': money_format(purchase.price_cents),
+            'bought_for': "".join([roster.initials[share.roommate_id] for share in purchase.shares]),
+            'split_mode': capitalize(purchase.split_mode),
+            'bought_when': purchase.bought_when,
+            'added_when': purchase.added_when,
+            'deleted_when': purchase.deleted_when,
+        }
+
+def transfer_rows(money_transfers):
+    roster = get_roster()
+    for money_transfer in money_transfers:
+        yield {
+            'id': money_transfer.id,
+            'name': money_transfer.name,
+            'who_paid': roster.names[money_transfer.who_paid],
+            'to_whom': roster.names[money_transfer.to_whom],
+            'amount': money_format(money_transfer.amount_cents),
+            'transferred_when': money_transfer.transferred_when,
+            'added_when': money_transfer.added_when,
+            'deleted_when': money_transfer.deleted_when,
+        }
 
 @app.route('/moneytransfer/view/<id>')
+@read_only
 @login_required
 def view_moneytransfer(id):
     if id == "all":
-        return render_template("view_all_moneytransfers.html", tab="finance", money_transfers=MoneyTransfer.query.order_by(MoneyTransfer.transferred_when.desc(), MoneyTransfer.added_when.desc()).all())
+        columns = TRANSFER_HISTORY
+        if 'stream' in request.args:
+            return stream_history("view_all_moneytransfers.html", "money_transfers", MoneyTransfer.query, columns, transfer_rows, tab="finance", next_cursor=None)
+        money_transfers, next_cursor = paginate_history(MoneyTransfer.query, columns)
+        return render_template("view_all_moneytransfers.html", tab="finance", money_transfers=transfer_rows(money_transfers), next_cursor=next_cursor)
     else:
         money_transfer = MoneyTransfer.query.get(int(id))
         if money_transfer == None:
@@ -586,13 +1909,14 @@ def view_moneytransfer(id):
             'to_whom': get_roommate_name(money_transfer.to_whom),
             'additional_info': money_transfer.additional_info,
             'method': money_transfer.method,
-            'amount': money_transfer.amount,
-            'transferred_when': f"{money_transfer.transferred_when:%Y-%m-%d}",
+            'amount': money_format(money_transfer.amount_cents),
+            'transferred_when': date_field(money_transfer.transferred_when),
             'added_when': time_conv(money_transfer.added_when),
         }
         return render_template('view_moneytransfer.html', tab='finance', money_transfer=data, id=id)
 
 @app.route('/moneytransfer/edit/<id>', methods=['GET', 'POST'])
+@read_only
 @login_required
 def edit_moneytransfer(id):
     money_transfer = MoneyTransfer.query.get(int(id))
@@ -603,16 +1927,16 @@ def edit_moneytransfer(id):
             'to_whom': get_roommate_name(money_transfer.to_whom),
             'additional_info': money_transfer.additional_info,
             'method': money_transfer.method,
-            'amount': money_transfer.amount,
-            'transferred_when': f"{money_transfer.transferred_when:%Y-%m-%d}",
+            'amount': dollars(money_transfer.amount_cents),
+            'transferred_when': date_field(money_transfer.transferred_when),
         }
-        return render_template('edit_moneytransfer.html', tab='finance', data=data, can_delete=(data['who_paid'].lower() == current_user.name.lower()), id=id, roommates=roommates, methods=payment_methods)
+        return render_template('edit_moneytransfer.html', tab='finance', data=data, can_delete=(data['who_paid'].lower() == current_user.name.lower()), id=id, methods=payment_methods)
     else:
         if 'save' in request.form:
             name = request.form["name"]
             try:
-                amount = float(request.form["amount"])
-            except:
+                amount_cents = parse_cents(request.form["amount"])
+            except ValueError:
                 flash("Error parsing amount.")
                 return redirect(url_for("add_moneytransfer"))
             additional_info = request.form["additional_info"]
@@ -625,10 +1949,10 @@ def edit_moneytransfer(id):
             if to_whom == who_paid:
                 flash("Can't pay yourself.")
                 return redirect(url_for("add_moneytransfer"))
-            if amount <= 0:
+            if amount_cents <= 0:
                 flash("Must pay a positive amount of money.")
                 return redirect(url_for("add_moneytransfer"))
-            if amount > 5000:
+            if amount_cents > MAX_CENTS:
                 flash("Too much money. Check for typos.")
                 return redirect(url_for("add_moneytransfer"))
             try:
@@ -637,23 +1961,27 @@ def edit_moneytransfer(id):
                 flash("Could not parse date.")
                 return redirect(url_for("add_moneytransfer"))
 
+            apply_to_ledger(transfer_contributions(money_transfer), -1)
             money_transfer.name = name
             money_transfer.method = method
             money_transfer.to_whom = to_whom
             money_transfer.who_paid = who_paid
             money_transfer.additional_info = additional_info
-            money_transfer.amount = amount
+            money_transfer.amount_cents = amount_cents
             money_transfer.transferred_when = transferred_when
+            bump_version('finance')
+            apply_to_ledger(transfer_contributions(money_transfer))
 
             db.session.commit()
             flash("Saved successfully.")
             return redirect(url_for('view_moneytransfer', id=id))
         elif 'delete' in request.form:
-            print("TODO log deletion and save copy of deleted money transfer.")
             if get_roommate_name(money_transfer.who_paid).lower() == current_user.name.lower():
-                db.session.delete(money_transfer)
+                apply_to_ledger(transfer_contributions(money_transfer), -1)
+                bump_version('finance')
+                money_transfer.deleted_when = datetime.datetime.utcnow()
                 db.session.commit()
-                flash("Deleted money transfer id %s, '%s'." % (money_transfer.id, money_transfer.name))
+                flash("Deleted money transfer id %s, '%s'. You can restore it from the recently deleted list." % (money_transfer.id, money_transfer.name))
                 return redirect(url_for('finance', id=id))
             else:
                 flash("You can only delete your own money transfers.")
@@ -661,6 +1989,719 @@ def edit_moneytransfer(id):
         else:
             return abort(400)
 
+@app.route('/purchase/restore/<int:id>', methods=['POST'])
+@login_required
+def restore_purchase(id):
+    purchase = Purchase.query.execution_options(include_deleted=True).filter_by(id=id).first()
+    if purchase is None or purchase.deleted_when is None:
+        flash("Couldn't find that deleted purchase.")
+        return redirect(url_for('deleted_finance'))
+    if get_roommate_name(purchase.bought_by).lower() != current_user.name.lower():
+        flash("You can only restore your own purchases.")
+        return redirect(url_for('deleted_finance'))
+    purchase.deleted_when = None
+    apply_purchase(purchase)
+    bump_version('finance')
+    db.session.commit()
+    flash("Restored purchase id %s, '%s'." % (purchase.id, purchase.name))
+    return redirect(url_for('view_purchase', id=id))
+
+@app.route('/moneytransfer/restore/<int:id>', methods=['POST'])
+@login_required
+def restore_moneytransfer(id):
+    money_transfer = MoneyTransfer.query.execution_options(include_deleted=True).filter_by(id=id).first()
+    if money_transfer is None or money_transfer.deleted_when is None:
+        flash("Couldn't find that deleted money transfer.")
+        return redirect(url_for('deleted_finance'))
+    if get_roommate_name(money_transfer.who_paid).lower() != current_user.name.lower():
+        flash("You can only restore your own money transfers.")
+        return redirect(url_for('deleted_finance'))
+    money_transfer.deleted_when = None
+    apply_to_ledger(transfer_contributions(money_transfer))
+    bump_version('finance')
+    db.session.commit()
+    flash("Restored money transfer id %s, '%s'." % (money_transfer.id, money_transfer.name))
+    return redirect(url_for('view_moneytransfer', id=id))
+
+DELETED_LIMIT = 50
+
+@app.route('/finance/deleted')
+@read_only
+@login_required
+def deleted_finance():
+    purchases = Purchase.query.options(db.selectinload(Purchase.shares)).execution_options(include_deleted=True) \
+        .filter(Purchase.deleted_when != None).order_by(Purchase.deleted_when.desc()).limit(DELETED_LIMIT)
+    money_transfers = MoneyTransfer.query.execution_options(include_deleted=True) \
+        .filter(MoneyTransfer.deleted_when != None).order_by(MoneyTransfer.deleted_when.desc()).limit(DELETED_LIMIT)
+    return render_template('deleted.html', tab='finance', purchases=list(purchase_rows(purchases)), money_transfers=list(transfer_rows(money_transfers)))
+
+# entity type (table name) -> (what to call one, tab)
+AUDITED_TYPES = {
+    'purchase': ("Purchase", 'finance'),
+    'money_transfer': ("Money transfer", 'finance'),
+    'grocery': ("Grocery", 'groceries'),
+    'task': ("Task", 'tasks'),
+    'member': ("Member", 'home'),
+}
+
+@app.route('/history/<entity_type>/<entity_id>')
+@read_only
+@login_required
+def entity_history(entity_type, entity_id):
+    if entity_type not in AUDITED_TYPES:
+        return abort(404)
+    events = AuditEvent.query.filter_by(entity_type=entity_type, entity_id=entity_id).order_by(AuditEvent.id).all()
+    if len(events) == 0:
+        return abort(404)
+    rows = []
+    previous = {}
+    for event in events:
+        data = json.loads(event.data)
+        if event.action in ('create', 'update'):
+            changes = [(key, previous.get(key), value) for key, value in data.items() if previous.get(key) != value and key != 'household_id']
+        else:
+            changes = []
+        rows.append({'at': event.at, 'actor': event.actor, 'action': event.action, 'changes': changes})
+        previous = data
+    rows.reverse()
+    label, tab = AUDITED_TYPES[entity_type]
+    return render_template('history.html', tab=tab, title="%s %s" % (label, entity_id), events=rows)
+
+SEARCH_PAGE_SIZE = 20
+SEARCH_TYPES = {'purchase': "Purchases", 'money_transfer': "Money transfers", 'grocery': "Groceries"}
+
+def search_query(text, household_id, kind=None):
+    # every word has to match, as a prefix. quoting each word keeps fts5
+    # syntax in what people type from being interpreted.
+    words = " ".join(['"%s"*' % word for word in re.findall(r'\w+', text)])
+    if not words:
+        return None
+    scope = "h%d" % household_id + (" " + kind.replace('_', '') if kind else "")
+    # what people type only matches the visible columns, never the scope words
+    return "scope : (%s) AND {name body} : (%s)" % (scope, words)
+
+def search_highlight(text):
+    return Markup.escape(text or '').replace('\x02', Markup('<mark>')).replace('\x03', Markup('</mark>'))
+
+def search_link(kind, entity_id, archived):
+    if kind == 'purchase':
+        return url_for('view_purchase', id=entity_id)
+    elif kind == 'money_transfer':
+        return url_for('view_moneytransfer', id=entity_id)
+    elif entity_id is None:
+        return None
+    elif archived:
+        return url_for('entity_history', entity_type='grocery', entity_id=entity_id)
+    return url_for('groceries')
+
+@app.route('/search')
+@read_only
+@login_required
+def search():
+    text = request.args.get('q', '').strip()
+    kind = request.args.get('type', '')
+    page = max(request.args.get('page', 1, type=int), 1)
+    if kind not in SEARCH_TYPES:
+        kind = ''
+    filters = {'query': search_query(text, current_household_id(), kind), 'limit': SEARCH_PAGE_SIZE + 1, 'offset': (page - 1) * SEARCH_PAGE_SIZE}
+    conditions = ['search_index MATCH :query']
+    try:
+        # dates are stored as text, which sorts the same way
+        if request.args.get('start'):
+            filters['start'] = str(datetime.datetime.strptime(request.args['start'], '%Y-%m-%d'))
+            conditions.append('happened >= :start')
+        if request.args.get('end'):
+            filters['end'] = str(datetime.datetime.strptime(request.args['end'], '%Y-%m-%d') + timedelta(days=1))
+            conditions.append('happened < :end')
+    except ValueError:
+        flash("Dates must look like 2024-05-31.")
+        return redirect(url_for('search', q=text, type=kind))
+    results = []
+    if filters['query']:
+        rows = db.session.execute(sqlalchemy.text(
+            "SELECT kind, entity_id, archived, happened, highlight(search_index, 0, char(2), char(3)) AS name, snippet(search_index, 1, char(2), char(3), '...', 12) AS body "
+            "FROM search_index WHERE %s ORDER BY rank LIMIT :limit OFFSET :offset" % " AND ".join(conditions)), filters).all()
+        for row in rows[:SEARCH_PAGE_SIZE]:
+            results.append({
+                'type': AUDITED_TYPES[row.kind][0],
+                'name': search_highlight(row.name),
+                'body': search_highlight(row.body),
+                'archived': bool(row.archived),
+                'happened': row.happened[:10] if row.happened else '',
+                'url': search_link(row.kind, row.entity_id, row.archived),
+            })
+        has_next = len(rows) > SEARCH_PAGE_SIZE
+    else:
+        has_next = False
+    args = dict([(key, value) for key, value in request.args.items() if key != 'page'])
+    return render_template('search.html', tab='search', q=text, type=kind, start=request.args.get('start', ''), end=request.args.get('end', ''), types=SEARCH_TYPES, results=results, page=page,
+                           previous_url=url_for('search', page=page - 1, **args) if page > 1 else None,
+                           next_url=url_for('search', page=page + 1, **args) if has_next else None)
+
+@app.cli.command('rebuild-search')
+def rebuild_search():
+    """Recreate the search index from the current data, the audit log and old grocery logs."""
+    db.create_all()
+    with db.engine.begin() as connection:
+        if not create_search_index(connection):
+            return
+        fill_search_index(connection)
+        count = connection.exec_driver_sql('SELECT count(*) FROM search_index').scalar()
+        connection.exec_driver_sql("INSERT INTO search_index (search_index) VALUES ('optimize')")
+    print("Indexed %d rows." % count)
+
+def purge_groceries():
+    # groceries that have been removed for more than a week, one set-based
+    # delete per household. the audit log keeps a copy of each one, written
+    # in bulk from what the deletes return rather than through log_changes.
+    cutoff = datetime.datetime.now() - timedelta(weeks=1)
+    grocery = GroceryItem.__table__
+    vote = GroceryVote.__table__
+    for household_id in household_ids():
+        expired = db.and_(grocery.c.household_id == household_id, grocery.c.recently_bought == True, grocery.c.bought_when < cutoff)
+        with in_household(household_id):
+            voters = {}
+            for grocery_id, member_id in db.session.execute(vote.delete().where(vote.c.grocery_id.in_(db.select(grocery.c.id).where(expired))).returning(vote.c.grocery_id, vote.c.member_id)):
+                voters.setdefault(grocery_id, []).append(member_id)
+            purged = db.session.execute(grocery.delete().where(expired).returning(*grocery.columns)).all()
+            if len(purged) == 0:
+                db.session.rollback()
+                continue
+            audit_rows = [audit_row('grocery', str(row.id), 'delete', dict(row._mapping, voters=sorted(voters.get(row.id, []))), household_id) for row in purged]
+            db.session.execute(db.insert(AuditEvent), audit_rows)
+            bump_version('groceries')
+            db.session.commit()
+            print("Purged %d old groceries from household %d." % (len(purged), household_id))
+
+def generate_current_week():
+    # runs every minute so the new week exists as soon as it starts. next week
+    # can't be generated ahead of time since it carries over this week's
+    # unfinished tasks.
+    week = get_week_id()
+    generated = db.select(WeeklyTasks.household_id).where(WeeklyTasks.week_id == week)
+    for (household_id,) in db.session.query(Household.id).filter(Household.id.not_in(generated)).all():
+        with in_household(household_id):
+            generate_week(week)
+
+def process_pending_receipts():
+    # picks up receipts whose queued processing was lost, e.g. to a restart
+    cutoff = datetime.datetime.utcnow() - timedelta(minutes=5)
+    pending = db.session.query(Receipt.id, Receipt.household_id).filter(Receipt.status == 'pending', Receipt.added_when < cutoff).execution_options(all_households=True).all()
+    for id, household_id in pending:
+        process_receipt(id, household_id)
+
+AUDIT_BATCH_SIZE = 10000
+
+def compact_audit_log():
+    # events older than AUDIT_RETENTION_DAYS are collapsed to the newest one
+    # per entity. each event holds a whole copy of the row, so that one still
+    # shows what the entity looked like at the cutoff.
+    cutoff = datetime.datetime.utcnow() - timedelta(days=app.config['AUDIT_RETENTION_DAYS'])
+    rows = db.session.query(AuditEvent.id, AuditEvent.household_id, AuditEvent.entity_type, AuditEvent.entity_id) \
+        .filter(AuditEvent.at < cutoff).execution_options(all_households=True) \
+        .order_by(AuditEvent.household_id, AuditEvent.entity_type, AuditEvent.entity_id, AuditEvent.id.desc())
+    stale = []
+    previous = None
+    for id, household_id, entity_type, entity_id in rows.yield_per(AUDIT_BATCH_SIZE):
+        if (household_id, entity_type, entity_id) == previous:
+            stale.append(id)
+        previous = (household_id, entity_type, entity_id)
+    # short transactions so requests aren't kept waiting on the write lock
+    for start in range(0, len(stale), AUDIT_BATCH_SIZE):
+        db.session.execute(db.delete(AuditEvent).where(AuditEvent.id.in_(stale[start:start + AUDIT_BATCH_SIZE])).execution_options(all_households=True))
+        db.session.commit()
+    print("Removed %d superseded audit events." % len(stale))
+
+# name -> (function, seconds between runs)
+jobs = {
+    'generate-tasks': (generate_current_week, 60),
+    'purge-groceries': (purge_groceries, 60 * 60),
+    'process-receipts': (process_pending_receipts, 10 * 60),
+    'compact-audit-log': (compact_audit_log, 24 * 60 * 60),
+}
+
+def acquire_job_lock(name, seconds):
+    now = datetime.datetime.utcnow()
+    db.session.execute(sqlite_insert(JobLock).values(name=name, locked_until=datetime.datetime.min).on_conflict_do_nothing())
+    acquired = JobLock.query.filter(JobLock.name == name, JobLock.locked_until < now).update({'locked_until': now + timedelta(seconds=seconds)})
+    db.session.commit()
+    return acquired == 1
+
+def release_job_lock(name):
+    JobLock.query.filter_by(name=name).update({'locked_until': datetime.datetime.min})
+    db.session.commit()
+
+def run_job(name):
+    function, interval = jobs[name]
+    with app.app_context():
+        if not acquire_job_lock(name, interval):
+            return False
+        try:
+            function()
+        finally:
+            db.session.rollback()
+            release_job_lock(name)
+    return True
+
+def start_scheduler():
+    def loop():
+        next_run = dict.fromkeys(jobs, 0)
+        while True:
+            for name, (function, interval) in jobs.items():
+                if time.time() >= next_run[name]:
+                    try:
+                        run_job(name)
+                    except Exception:
+                        traceback.print_exc()
+                    next_run[name] = time.time() + interval
+            time.sleep(1)
+    thread = threading.Thread(target=loop, name='scheduler', daemon=True)
+    thread.start()
+    return thread
+
+@app.cli.command('run-job')
+@click.argument('name', type=click.Choice(sorted(jobs)))
+def run_job_command(name):
+    """Run one background job now."""
+    if run_job(name):
+        print("Ran %s." % name)
+    else:
+        print("%s is already running elsewhere." % name)
+
+PURCHASE_FIELDS = ['id', 'name', 'bought_when', 'added_when', 'bought_by', 'bought_for', 'spending_type', 'price', 'split_mode', 'shares', 'additional_info']
+TRANSFER_FIELDS = ['id', 'name', 'transferred_when', 'added_when', 'who_paid', 'to_whom', 'amount', 'method', 'additional_info']
+EXPORT_BATCH_SIZE = 1000
+
+def purchase_record(purchase):
+    return {
+        'id': purchase.id,
+        'name': purchase.name,
+        # undated legacy purchases go out with the day they were entered, like in the rollups
+        'bought_when': date_field(purchase.bought_when or purchase.added_when),
+        'added_when': purchase.added_when.isoformat() if purchase.added_when else '',
+        'bought_by': get_roommate_name(purchase.bought_by),
+        'bought_for': ";".join([capitalize(x) for x in member_names(beneficiary_ids(purchase))]),
+        'spending_type': purchase.spending_type,
+        'price': purchase.price_cents / 100,
+        'split_mode': purchase.split_mode,
+        'shares': ";".join(["%s:%d" % (get_roommate_name(share.roommate_id), share.share) for share in purchase.shares]),
+        'additional_info': purchase.additional_info,
+    }
+
+def transfer_record(money_transfer):
+    return {
+        'id': money_transfer.id,
+        'name': money_transfer.name,
+        'transferred_when': date_field(money_transfer.transferred_when or money_transfer.added_when),
+        'added_when': money_transfer.added_when.isoformat() if money_transfer.added_when else '',
+        'who_paid': get_roommate_name(money_transfer.who_paid),
+        'to_whom': get_roommate_name(money_transfer.to_whom),
+        'amount': money_transfer.amount_cents / 100,
+        'method': money_transfer.method,
+        'additional_info': money_transfer.additional_info,
+    }
+
+def export_records(kind):
+    # yield_per streams rows off the cursor in batches instead of loading the table
+    if kind == 'purchases':
+        query = Purchase.query.options(db.selectinload(Purchase.shares)).order_by(Purchase.id)
+        to_record = purchase_record
+    else:
+        query = MoneyTransfer.query.order_by(MoneyTransfer.id)
+        to_record = transfer_record
+    for row in query.yield_per(EXPORT_BATCH_SIZE):
+        yield to_record(row)
+
+def format_records(records, fmt, fields):
+    # yields chunks of roughly EXPORT_BATCH_SIZE rows
+    buffer = io.StringIO()
+    if fmt == 'csv':
+        writer = csv.DictWriter(buffer, fields)
+        writer.writeheader()
+    for count, record in enumerate(records, 1):
+        if fmt == 'csv':
+            writer.writerow(record)
+        else:
+            buffer.write(json.dumps(record) + "\n")
+        if count % EXPORT_BATCH_SIZE == 0:
+            yield buffer.getvalue()
+            buffer.seek(0)
+            buffer.truncate()
+    yield buffer.getvalue()
+
+@app.route('/finance/export/<kind>.<fmt>')
+@read_only
+@login_required
+def export_ledger(kind, fmt):
+    if kind not in ('purchases', 'transfers') or fmt not in ('csv', 'ndjson'):
+        return abort(404)
+    fields = PURCHASE_FIELDS if kind == 'purchases' else TRANSFER_FIELDS
+    mimetype = 'text/csv' if fmt == 'csv' else 'application/x-ndjson'
+    response = Response(stream_with_context(format_records(export_records(kind), fmt, fields)), mimetype=mimetype)
+    response.headers['Content-Disposition'] = 'attachment; filename=%s.%s' % (kind, fmt)
+    return response
+
+@app.cli.command('export-ledger')
+@click.argument('kind', type=click.Choice(['purchases', 'transfers']))
+@click.option('--format', 'fmt', type=click.Choice(['csv', 'ndjson']), default='csv')
+@click.option('--output', type=click.File('w'), default='-')
+@household_option
+def export_ledger_command(kind, fmt, output):
+    """Write every purchase or money transfer as CSV or NDJSON."""
+    fields = PURCHASE_FIELDS if kind == 'purchases' else TRANSFER_FIELDS
+    for chunk in format_records(export_records(kind), fmt, fields):
+        output.write(chunk)
+
+def read_records(path, fmt):
+    # yields (line number, record dict)
+    with open(path, newline='') as f:
+        if fmt == 'csv':
+            reader = csv.DictReader(f)
+            for record in reader:
+                yield reader.line_num, record
+        else:
+            for line_num, line in enumerate(f, 1):
+                if line.strip():
+                    yield line_num, line
+
+def load_record(record):
+    # ndjson lines arrive as text so a bad one is reported like any other
+    # invalid row instead of ending the import
+    if isinstance(record, str):
+        try:
+            record = json.loads(record)
+        except ValueError as e:
+            raise ValueError("bad json: %s" % e)
+        if not isinstance(record, dict):
+            raise ValueError("expected a json object, got %s" % type(record).__name__)
+    return record
+
+def parse_roommate(value, field):
+    id = get_roommate_id(str(value or ''))
+    if id is None:
+        raise ValueError("unknown roommate %r in %s" % (value, field))
+    return id
+
+def parse_date(value, field):
+    try:
+        return datetime.datetime.strptime(str(value)[:10], '%Y-%m-%d')
+    except ValueError:
+        raise ValueError("bad date %r in %s" % (value, field))
+
+def parse_amount(value, field):
+    # returns cents
+    try:
+        cents = parse_cents(value)
+    except ValueError:
+        raise ValueError("bad amount %r in %s" % (value, field))
+    if cents < 0 or cents >= MAX_CENTS:
+        raise ValueError("%s out of range: %s" % (field, value))
+    return cents
+
+def parse_purchase(record):
+    bought_for = record.get('bought_for') or ''
+    if isinstance(bought_for, str):
+        bought_for = [name for name in bought_for.replace(',', ';').split(';') if name.strip()]
+    bought_for = [parse_roommate(name.strip(), 'bought_for') for name in bought_for]
+    if len(bought_for) == 0:
+        raise ValueError("bought_for names no roommates")
+    spending_type = str(record.get('spending_type') or '').lower()
+    if spending_type not in spending_types:
+        raise ValueError("unknown spending_type %r" % record.get('spending_type'))
+    split_mode = record.get('split_mode') or 'even'
+    if split_mode != 'even':
+        raise ValueError("unknown split_mode %r" % split_mode)
+    return {
+        'name': str(record.get('name') or ''),
+        'bought_when': parse_date(record.get('bought_when'), 'bought_when'),
+        'bought_by': parse_roommate(record.get('bought_by'), 'bought_by'),
+        'beneficiaries': bought_for,
+        'spending_type': spending_type,
+        'price_cents': parse_amount(record.get('price'), 'price'),
+        'split_mode': split_mode,
+        'additional_info': str(record.get('additional_info') or ''),
+    }
+
+def parse_transfer(record):
+    row = {
+        'name': str(record.get('name') or ''),
+        'transferred_when': parse_date(record.get('transferred_when'), 'transferred_when'),
+        'who_paid': parse_roommate(record.get('who_paid'), 'who_paid'),
+        'to_whom': parse_roommate(record.get('to_whom'), 'to_whom'),
+        'amount_cents': parse_amount(record.get('amount'), 'amount'),
+        'method': str(record.get('method') or '').lower(),
+        'additional_info': str(record.get('additional_info') or ''),
+    }
+    if row['method'] not in payment_methods:
+        raise ValueError("unknown method %r" % record.get('method'))
+    if row['who_paid'] == row['to_whom']:
+        raise ValueError("who_paid and to_whom are the same person")
+    if row['amount_cents'] <= 0:
+        raise ValueError("amount must be positive")
+    return row
+
+def purchase_key(row):
+    return (row['bought_when'].date(), row['price_cents'], row['bought_by'], tuple(sorted(set(row['beneficiaries']))))
+
+def transfer_key(row):
+    return (row['transferred_when'].date(), row['amount_cents'], row['who_paid'], row['to_whom'])
+
+def existing_keys(kind, rows):
+    # keys already in the database within the date range being imported
+    if len(rows) == 0:
+        return set()
+    if kind == 'purchases':
+        when = Purchase.bought_when
+        query = db.session.query(Purchase.bought_when, Purchase.price_cents, Purchase.bought_by, db.func.group_concat(PurchaseShare.roommate_id)) \
+            .outerjoin(PurchaseShare, PurchaseShare.purchase_id == Purchase.id).group_by(Purchase.id)
+        to_key = lambda r: purchase_key({'bought_when': r[0], 'price_cents': r[1], 'bought_by': r[2], 'beneficiaries': [int(id) for id in (r[3] or '').split(',') if id]})
+        dates = [row['bought_when'] for row in rows]
+    else:
+        when = MoneyTransfer.transferred_when
+        query = db.session.query(MoneyTransfer.transferred_when, MoneyTransfer.amount_cents, MoneyTransfer.who_paid, MoneyTransfer.to_whom)
+        to_key = lambda r: transfer_key({'transferred_when': r[0], 'amount_cents': r[1], 'who_paid': r[2], 'to_whom': r[3]})
+        dates = [row['transferred_when'] for row in rows]
+    query = query.filter(when >= min(dates), when < max(dates) + timedelta(days=1))
+    return set([to_key(r) for r in query.yield_per(EXPORT_BATCH_SIZE)])
+
+def insert_purchases(rows, first_id):
+    # computes every split up front, then inserts purchases and shares with
+    # executemany and updates the ledger and rollups once per cell
+    share_rows = []
+    owes_delta = {}
+    rollup_deltas = {}
+    audit_rows = []
+    for id, row in enumerate(rows, first_id):
+        row['id'] = id
+        row['added_when'] = datetime.datetime.utcnow()
+        beneficiaries = row.pop('beneficiaries')
+        shares = list(zip(beneficiaries, split_cents(row['price_cents'], len(beneficiaries))))
+        audit_rows.append(audit_row('purchase', str(id), 'create', dict(row, shares=shares), current_household_id()))
+        for index, share in shares:
+            share_rows.append({'purchase_id': id, 'roommate_id': index, 'share': share})
+            if index != row['bought_by'] and share != 0:
+                owes_delta[(index, row['bought_by'])] = owes_delta.get((index, row['bought_by']), 0) + share
+        add_rollup_deltas(rollup_deltas, row['bought_when'], row['spending_type'], row['bought_by'], shares)
+    db.session.execute(db.insert(Purchase), rows)
+    db.session.execute(db.insert(PurchaseShare), share_rows)
+    db.session.execute(db.insert(AuditEvent), audit_rows)
+    apply_to_ledger([(debtor, creditor, cents) for (debtor, creditor), cents in owes_delta.items()])
+    apply_rollup_deltas(rollup_deltas)
+
+def insert_transfers(rows, first_id):
+    owes_delta = {}
+    for id, row in enumerate(rows, first_id):
+        row['id'] = id
+        row['added_when'] = datetime.datetime.utcnow()
+        owes_delta[(row['to_whom'], row['who_paid'])] = owes_delta.get((row['to_whom'], row['who_paid']), 0) + row['amount_cents']
+    db.session.execute(db.insert(MoneyTransfer), rows)
+    db.session.execute(db.insert(AuditEvent), [audit_row('money_transfer', str(row['id']), 'create', row, current_household_id()) for row in rows])
+    apply_to_ledger([(debtor, creditor, cents) for (debtor, creditor), cents in owes_delta.items()])
+
+@app.cli.command('import-ledger')
+@click.argument('kind', type=click.Choice(['purchases', 'transfers']))
+@click.argument('path', type=click.Path(exists=True, dir_okay=False))
+@click.option('--format', 'fmt', type=click.Choice(['csv', 'ndjson']), help='Defaults to the file extension.')
+@click.option('--dry-run', is_flag=True, help='Validate and report without writing anything.')
+@click.option('--skip-invalid', is_flag=True, help='Import the valid rows even if some are invalid.')
+@click.option('--batch-size', default=1000, help='Rows per transaction.')
+@household_option
+def import_ledger(kind, path, fmt, dry_run, skip_invalid, batch_size):
+    """Bulk import purchases or money transfers from CSV or NDJSON."""
+    if fmt is None:
+        fmt = 'ndjson' if path.endswith(('.ndjson', '.jsonl')) else 'csv'
+    parse = parse_purchase if kind == 'purchases' else parse_transfer
+    to_key = purchase_key if kind == 'purchases' else transfer_key
+
+    rows = []
+    invalid = 0
+    for line_num, record in read_records(path, fmt):
+        try:
+            rows.append(parse(load_record(record)))
+        except ValueError as e:
+            invalid += 1
+            print("Line %d: %s" % (line_num, e))
+
+    seen = existing_keys(kind, rows)
+    new_rows = []
+    for row in rows:
+        key = to_key(row)
+        if key not in seen:
+            seen.add(key)
+            new_rows.append(row)
+    duplicates = len(rows) - len(new_rows)
+    print("%d valid, %d invalid, %d duplicates, %d to import." % (len(rows), invalid, duplicates, len(new_rows)))
+    if dry_run or len(new_rows) == 0:
+        return
+    if invalid > 0 and not skip_invalid:
+        print("Not importing anything. Fix the invalid rows or pass --skip-invalid.")
+        return
+
+    model = Purchase if kind == 'purchases' else MoneyTransfer
+    insert = insert_purchases if kind == 'purchases' else insert_transfers
+    for start in range(0, len(new_rows), batch_size):
+        first_id = (db.session.query(db.func.max(model.id)).execution_options(all_households=True, include_deleted=True).scalar() or 0) + 1
+        insert(new_rows[start:start + batch_size], first_id)
+        bump_version('finance')
+        db.session.commit()
+    print("Imported %d %s." % (len(new_rows), kind))
+
+class ApiError(Exception):
+    pass
+
+@app.errorhandler(ApiError)
+def api_error(e):
+    db.session.rollback()
+    return jsonify(error=str(e)), 400
+
+def api_operations():
+    body = request.get_json(silent=True)
+    if body is None or not isinstance(body.get('operations'), list):
+        raise ApiError("Expected a json body with a list of operations.")
+    return body['operations']
+
+def grocery_json(grocery):
+    return {
+        'id': grocery.id,
+        'name': grocery.name,
+        'quantity': grocery.quantity,
+        'note': grocery.note,
+        'votes': member_names(voter_ids(grocery)),
+        'votes_string': initials(voter_ids(grocery)),
+        'recently_bought': grocery.recently_bought,
+        'bought_by': grocery.bought_by,
+        'bought_when': grocery.bought_when.isoformat() if grocery.bought_when else None,
+    }
+
+def task_json(task):
+    return {
+        'id': task.task_id,
+        'week': task.week_id,
+        'name': task.name,
+        'assigned_to': task.assigned_to,
+        'completed': task.completed,
+        'overdue': task.overdue,
+    }
+
+@app.route('/api/groceries', methods=['GET', 'POST'])
+@login_required
+def api_groceries():
+    """
+    GET lists groceries (?show_bought to include bought ones). POST applies a
+    batch like {"operations": [{"action": "vote", "id": 3}, {"action": "add",
+    "name": "Milk", "quantity": 1, "note": ""}]} in one transaction and
+    returns the rows it changed.
+    """
+    if request.method == 'GET':
+        query = GroceryItem.query.options(db.selectinload(GroceryItem.voters))
+        if 'show_bought' not in request.args:
+            query = query.filter_by(recently_bought=False)
+        return jsonify(groceries=[grocery_json(grocery) for grocery in query.order_by(GroceryItem.id)], version=get_version('groceries'))
+
+    changed = {}
+    for operation in api_operations():
+        action = operation.get('action')
+        if action == "add":
+            name = str(operation.get('name', ''))
+            if len(name.strip()) < 3:
+                raise ApiError("Please add a name of at least 3 characters.")
+            try:
+                quantity = int(operation.get('quantity', 1))
+            except (TypeError, ValueError):
+                raise ApiError("Quantity must be a number.")
+            grocery = new_grocery(name, quantity, str(operation.get('note', '')))
+            db.session.flush()
+        elif action in ("vote", "delete", "undelete"):
+            grocery = GroceryItem.query.get(operation.get('id'))
+            if grocery is None:
+                raise ApiError("Nonexistent grocery %s." % operation.get('id'))
+            modify_grocery_item(grocery, action)
+        else:
+            raise ApiError("Unknown action %s." % action)
+        changed[grocery.id] = grocery
+    if len(changed) > 0:
+        bump_version('groceries')
+    deltas = [grocery_json(grocery) for grocery in changed.values()]
+    response = jsonify(groceries=deltas, version=get_version('groceries'))
+    db.session.commit()
+    for delta in deltas:
+        publish('grocery', delta)
+    return response
+
+@app.route('/api/tasks/<int:week>', methods=['GET', 'POST'])
+@login_required
+def api_tasks(week):
+    """
+    GET lists the week's tasks. POST applies a batch like {"operations":
+    [{"action": "complete", "id": 4}]} in one transaction and returns the
+    tasks it changed.
+    """
+    if not week_generated(week):
+        return jsonify(error="Nonexistent week."), 404
+    if request.method == 'GET':
+        return jsonify(tasks=[task_json(task) for task in Task.query.filter_by(week_id=week).order_by(Task.task_id)], version=get_version('tasks'))
+
+    completed = {}
+    for operation in api_operations():
+        action = operation.get('action')
+        if not (action == "complete" or action == "uncomplete"):
+            raise ApiError("Unknown action %s." % action)
+        try:
+            completed[int(operation.get('id'))] = action == "complete"
+        except (TypeError, ValueError):
+            raise ApiError("Task id must be a number.")
+    changed = []
+    if len(completed) > 0:
+        changed = Task.query.filter(Task.week_id == week, Task.task_id.in_(list(completed))).all()
+        if len(changed) != len(completed):
+            raise ApiError("Nonexistent task.")
+        for task in changed:
+            task.completed = completed[task.task_id]
+        bump_version('tasks')
+    response = jsonify(tasks=[task_json(task) for task in changed], version=get_version('tasks'))
+    db.session.commit()
+    for task in changed:
+        publish('task', {'id': task.task_id, 'week': week, 'completed': task.completed})
+    return response
+
+broker = events.Broker()
+events_signer = itsdangerous.URLSafeTimedSerializer(SECRET_KEY, salt='events')
+
+def publish(name, data):
+    # call after committing, so nobody is told about changes that were rolled back
+    broker.publish(current_household_id(), name, data)
+
+def events_household(token):
+    # the household an /events token was issued for, or None
+    try:
+        return events_signer.loads(token, max_age=app.config['EVENTS_TOKEN_MAX_AGE'])
+    except itsdangerous.BadData:
+        return None
+
+def start_event_server():
+    events.start(broker, app.config['HOST'], app.config['EVENTS_PORT'], events_household)
+
+@app.route('/api/events')
+@login_required
+def api_events():
+    """
+    Where to subscribe to live updates for your household: {"url": ...} to
+    open with EventSource. Events are "grocery" (a grocery like in
+    /api/groceries), "task" ({"id", "week", "completed"}), "week" (a new
+    week's tasks were generated) and "reload" (updates were missed).
+    """
+    if not broker.running:
+        return jsonify(error="Live updates are off."), 404
+    url = app.config['EVENTS_URL']
+    if url is None:
+        hostname = urllib.parse.urlsplit(request.host_url).hostname
+        if ':' in hostname:
+            hostname = '[%s]' % hostname
+        url = '%s://%s:%d/events' % (request.scheme, hostname, app.config['EVENTS_PORT'])
+    response = jsonify(url=url + '?' + urllib.parse.urlencode({'token': events_signer.dumps(current_household_id())}))
+    response.headers['Cache-Control'] = 'no-store'
+    return response
+
 """
 @app.context_processor
 def inject_week():
@@ -670,30 +2711,21 @@ def inject_week():
 @app.route('/authenticate_all')
 @login_required
 def authenticate_all():
-    users = User.query.all()
+    users = User.query.filter_by(household_id=current_household_id()).all()
     for user in users:
         user.authenticated = True
     db.session.commit()
+    user_cache.clear()
     return "done"
 
-@app.before_request
-def before_request():
-    g.start = time.time()
-
-@app.after_request
-def after_request(response):
-    diff = time.time() - g.start
-    if ((response.response) and
-        (200 <= response.status_code < 300) and
-        (response.content_type.startswith('text/html'))):
-        response.set_data(response.get_data().replace(
-            b'__EXECUTION_TIME__', bytes(str(diff), 'utf-8')))
-    return response
-
-import sys
-if len(sys.argv) > 1:
-    from waitress import serve
-    serve(app, host='0.0.0.0', port=5000)
-else:
-    app.run(host='0.0.0.0')
+if __name__ == '__main__':
+    import sys
+    start_scheduler()
+    if app.config['EVENTS_PORT']:
+        start_event_server()
+    if len(sys.argv) > 1:
+        from waitress import serve
+        serve(app, host=app.config['HOST'], port=app.config['PORT'], threads=app.config['THREADS'])
+    else:
+        app.run(host=app.config['HOST'], port=app.config['PORT'])
 
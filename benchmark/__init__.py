@@ -0,0 +1,4 @@
+"""
+Seeds a throwaway SQLite database with synthetic data and times the real
+routes against it. Run with `python -m benchmark --help`.
+"""
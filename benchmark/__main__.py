@@ -0,0 +1,129 @@
+"""
+python -m benchmark [--purchases N] [--requests N] [--uncached] [--output results.json]
+
+Seeds a fresh SQLite database, logs in as the first roommate and hits each
+route through the Flask test client, reporting latency percentiles, SQL
+queries per request and peak RSS. Compare the JSON output between runs to
+catch regressions.
+
+The first request to each route is reported separately, since it also loads
+and compiles the templates. --uncached empties the rendered fragment cache
+before every request so the timings include rendering the whole page.
+"""
+import argparse
+import json
+import os
+import resource
+import sys
+import tempfile
+import time
+
+ROUTES = ['/finance', '/owes', '/groceries', '/tasks/latest', '/purchase/view/all']
+
+def percentile(samples, fraction):
+    samples = sorted(samples)
+    index = min(len(samples) - 1, int(round(fraction * (len(samples) - 1))))
+    return samples[index]
+
+def peak_rss_kb():
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+def measure(A, routes, nrequests, user, uncached=False):
+    from sqlalchemy import event
+    from sqlalchemy.engine import Engine
+
+    queries = [0]
+    def count_query(*args):
+        queries[0] += 1
+    event.listen(Engine, 'before_cursor_execute', count_query)
+
+    client = A.app.test_client()
+    with client.session_transaction() as session:
+        session['_user_id'] = user
+        session['_fresh'] = True
+
+    results = {}
+    for route in routes:
+        # timed apart from the rest so lazy setup (task generation, caches,
+        # compiling templates) isn't counted in the percentiles
+        start = time.perf_counter()
+        client.get(route).get_data()
+        first = time.perf_counter() - start
+        latencies = []
+        queries[0] = 0
+        for i in range(nrequests):
+            if uncached:
+                A.page_cache.clear()
+            start = time.perf_counter()
+            response = client.get(route)
+            response.get_data()
+            latencies.append(time.perf_counter() - start)
+            if response.status_code != 200:
+                raise RuntimeError("%s returned %d" % (route, response.status_code))
+        results[route] = {
+            'first_ms': first * 1000,
+            'p50_ms': percentile(latencies, 0.50) * 1000,
+            'p95_ms': percentile(latencies, 0.95) * 1000,
+            'p99_ms': percentile(latencies, 0.99) * 1000,
+            'mean_ms': sum(latencies) / len(latencies) * 1000,
+            'queries_per_request': queries[0] / nrequests,
+        }
+        print("%-22s first %8.2fms  p50 %8.2fms  p95 %8.2fms  p99 %8.2fms  %5.1f queries" % (route, results[route]['first_ms'], results[route]['p50_ms'], results[route]['p95_ms'], results[route]['p99_ms'], results[route]['queries_per_request']))
+    event.remove(Engine, 'before_cursor_execute', count_query)
+    return results
+
+def main():
+    parser = argparse.ArgumentParser(description="Seed synthetic data and benchmark the app's routes.")
+    parser.add_argument('--purchases', type=int, default=1000)
+    parser.add_argument('--transfers', type=int, help='defaults to purchases / 10')
+    parser.add_argument('--groceries', type=int, default=200)
+    parser.add_argument('--weeks', type=int, default=52)
+    parser.add_argument('--requests', type=int, default=50, help='timed requests per route')
+    parser.add_argument('--routes', nargs='+', default=ROUTES)
+    parser.add_argument('--uncached', action='store_true', help='render every page from scratch instead of from the fragment cache')
+    parser.add_argument('--db', help='sqlite file to use (default: a temp file)')
+    parser.add_argument('--reuse', action='store_true', help="don't reseed --db if it already exists")
+    parser.add_argument('--output', help='write results as JSON here')
+    args = parser.parse_args()
+    if args.transfers is None:
+        args.transfers = args.purchases // 10
+
+    db_path = os.path.abspath(args.db or os.path.join(tempfile.mkdtemp(), 'benchmark.db'))
+    reuse = args.reuse and os.path.exists(db_path)
+    os.environ['DATABASE_URI'] = 'sqlite:///' + db_path
+    sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+    import app as A
+    from benchmark.seed import seed
+
+    with A.app.app_context():
+        seed_seconds = None
+        if not reuse:
+            print("Seeding %s..." % db_path)
+            start = time.perf_counter()
+            seed(A, args.purchases, args.transfers, args.groceries, args.weeks)
+            A.app.test_cli_runner().invoke(args=['rebuild-balances'])
+            A.app.test_cli_runner().invoke(args=['rebuild-rollups'])
+            seed_seconds = time.perf_counter() - start
+            print("Seeded in %.1fs." % seed_seconds)
+        routes = measure(A, args.routes, args.requests, A.roommates[0], uncached=args.uncached)
+
+    results = {
+        'config': {
+            'purchases': args.purchases,
+            'transfers': args.transfers,
+            'groceries': args.groceries,
+            'weeks': args.weeks,
+            'requests': args.requests,
+            'uncached': args.uncached,
+        },
+        'seed_seconds': seed_seconds,
+        'routes': routes,
+        'peak_rss_kb': peak_rss_kb(),
+    }
+    print("Peak RSS: %d KB" % results['peak_rss_kb'])
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
+
+if __name__ == '__main__':
+    main()
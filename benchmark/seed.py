@@ -0,0 +1,137 @@
+"""
+Fills the app's database with synthetic households, purchases, money
+transfers, groceries and weekly tasks. Rows are inserted with executemany in
+batches so seeding a million purchases doesn't go through the ORM one object
+at a time.
+"""
+import datetime
+import random
+
+BATCH_SIZE = 10000
+PASSWORD = 'benchmark'
+
+def batched(rows):
+    for start in range(0, len(rows), BATCH_SIZE):
+        yield rows[start:start + BATCH_SIZE]
+
+def insert(db, model, rows):
+    for batch in batched(rows):
+        db.session.execute(db.insert(model), batch)
+
+def random_date(rng, days):
+    return datetime.datetime(2019, 1, 1) + datetime.timedelta(days=rng.randrange(days), seconds=rng.randrange(86400))
+
+def member_names(A, household_id):
+    # the first household is A.roommates, the rest get numbered copies so
+    # every login is unique
+    if household_id == A.DEFAULT_HOUSEHOLD_ID:
+        return list(A.roommates)
+    return ['%s%d' % (name, household_id) for name in A.roommates]
+
+def seed(app_module, purchases, transfers, groceries, weeks, households=1, seed=0):
+    # the counts are per household
+    A = app_module
+    db = A.db
+    rng = random.Random(seed)
+    nroommates = len(A.roommates)
+    days = max(1, purchases // 10)
+    task_names = A.fetch_task_names()
+    current_week = A.get_week_id()
+    now = datetime.datetime.utcnow()
+
+    db.drop_all()
+    db.create_all()
+    with db.engine.begin() as connection:
+        connection.exec_driver_sql('DROP TABLE IF EXISTS search_index')
+        A.create_search_index(connection)
+    purchase_id = 0
+    transfer_id = 0
+    grocery_id = 0
+    for household_id in range(A.DEFAULT_HOUSEHOLD_ID, A.DEFAULT_HOUSEHOLD_ID + households):
+        names = member_names(A, household_id)
+        # member ids are global, so each household gets its own block
+        ids = [(household_id - A.DEFAULT_HOUSEHOLD_ID) * nroommates + index for index in range(nroommates)]
+        insert(db, A.Household, [{'id': household_id, 'name': 'Benchmark %d' % household_id}])
+        insert(db, A.Member, [{'id': id, 'household_id': household_id, 'name': name} for id, name in zip(ids, names)])
+        insert(db, A.User, [{'name': name, 'household_id': household_id, 'password': PASSWORD, 'authenticated': True} for name in names])
+
+        purchase_rows = []
+        share_rows = []
+        for i in range(purchases):
+            purchase_id += 1
+            beneficiaries = sorted(rng.sample(ids, rng.randint(1, nroommates)))
+            price_cents = rng.randint(100, 20000)
+            purchase_rows.append({
+                'id': purchase_id,
+                'household_id': household_id,
+                'name': 'Purchase %d' % purchase_id,
+                'bought_when': random_date(rng, days),
+                'bought_by': rng.choice(ids),
+                'spending_type': rng.choice(A.spending_types),
+                'price_cents': price_cents,
+                'split_mode': 'even',
+                'additional_info': '',
+            })
+            for id, share in zip(beneficiaries, A.split_cents(price_cents, len(beneficiaries))):
+                share_rows.append({'purchase_id': purchase_id, 'roommate_id': id, 'share': share})
+        insert(db, A.Purchase, purchase_rows)
+        insert(db, A.PurchaseShare, share_rows)
+        del purchase_rows, share_rows
+
+        transfer_rows = []
+        for i in range(transfers):
+            transfer_id += 1
+            who_paid, to_whom = rng.sample(ids, 2)
+            transfer_rows.append({
+                'id': transfer_id,
+                'household_id': household_id,
+                'name': 'Transfer %d' % transfer_id,
+                'who_paid': who_paid,
+                'to_whom': to_whom,
+                'amount_cents': rng.randint(100, 50000),
+                'transferred_when': random_date(rng, days),
+                'method': rng.choice(A.payment_methods),
+                'additional_info': '',
+            })
+        insert(db, A.MoneyTransfer, transfer_rows)
+        del transfer_rows
+
+        grocery_rows = []
+        vote_rows = []
+        for i in range(groceries):
+            grocery_id += 1
+            recently_bought = rng.random() < 0.5
+            grocery_rows.append({
+                'id': grocery_id,
+                'household_id': household_id,
+                'name': 'Grocery %d' % grocery_id,
+                'quantity': rng.randrange(1, 5),
+                'note': '',
+                'recently_bought': recently_bought,
+                'bought_by': rng.choice(names).lower() if recently_bought else None,
+                'added_when': now - datetime.timedelta(days=rng.randrange(30)),
+                'bought_when': now - datetime.timedelta(days=rng.randrange(14)),
+            })
+            for id in rng.sample(ids, rng.randint(0, nroommates)):
+                vote_rows.append({'grocery_id': grocery_id, 'member_id': id})
+        insert(db, A.GroceryItem, grocery_rows)
+        insert(db, A.GroceryVote, vote_rows)
+        del grocery_rows, vote_rows
+
+        week_rows = []
+        task_rows = []
+        for week in range(current_week - weeks + 1, current_week + 1):
+            week_rows.append({'household_id': household_id, 'week_id': week})
+            for index, name in enumerate(task_names):
+                task_rows.append({
+                    'household_id': household_id,
+                    'week_id': week,
+                    'task_id': index,
+                    'name': name,
+                    'assigned_to': names[(week + index) % nroommates],
+                    'completed': week != current_week or rng.random() < 0.5,
+                    'overdue': False,
+                })
+        insert(db, A.WeeklyTasks, week_rows)
+        insert(db, A.Task, task_rows)
+    db.session.commit()
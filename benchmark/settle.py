@@ -0,0 +1,66 @@
+"""
+python -m benchmark.settle [--items N] [--members 3 5 10 ...] [--output results.json]
+
+Generates random open items (one person paying for a few others) among N
+members, nets them into balances and times the greedy and exact settlement
+solvers on them. The exact solver is only run up to settle.EXACT_LIMIT
+members, since it's exponential.
+"""
+import argparse
+import json
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import settle
+
+MEMBERS = [3, 5, 10, 12, 25, 50, 100]
+
+def random_balances(rng, members, items):
+    balances = [0] * members
+    for i in range(items):
+        payer = rng.randrange(members)
+        beneficiaries = rng.sample(range(members), rng.randint(1, members))
+        share = rng.randrange(100, 20000)
+        for beneficiary in beneficiaries:
+            balances[payer] += share
+            balances[beneficiary] -= share
+    return balances
+
+def time_solver(solver, cases):
+    start = time.perf_counter()
+    transfers = [solver(balances) for balances in cases]
+    elapsed = time.perf_counter() - start
+    return {
+        'mean_ms': elapsed / len(cases) * 1000,
+        'mean_transfers': sum(len(result) for result in transfers) / len(cases),
+    }
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the settle-up solvers on random balances.")
+    parser.add_argument('--items', type=int, default=5000, help='open items per case')
+    parser.add_argument('--cases', type=int, default=20, help='random cases per member count')
+    parser.add_argument('--members', type=int, nargs='+', default=MEMBERS)
+    parser.add_argument('--output', help='write results as JSON here')
+    args = parser.parse_args()
+
+    rng = random.Random(0)
+    results = {}
+    for members in args.members:
+        cases = [random_balances(rng, members, args.items) for i in range(args.cases)]
+        result = {'greedy': time_solver(settle.settle_greedy, cases)}
+        line = "%4d members  greedy %9.3fms %7.2f transfers" % (members, result['greedy']['mean_ms'], result['greedy']['mean_transfers'])
+        if members <= settle.EXACT_LIMIT:
+            result['exact'] = time_solver(settle.settle_exact, cases)
+            line += "  exact %9.3fms %7.2f transfers" % (result['exact']['mean_ms'], result['exact']['mean_transfers'])
+        results[members] = result
+        print(line)
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump({'config': vars(args), 'members': results}, f, indent=2)
+
+if __name__ == '__main__':
+    main()
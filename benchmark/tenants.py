@@ -0,0 +1,99 @@
+"""
+python -m benchmark.tenants [--tenants 1 10 100 1000] [--requests N] [--output results.json]
+
+Seeds the same amount of data into every household for each tenant count and
+times the routes with requests spread round-robin over one user from each
+household. Per-request latency and queries should stay flat as the number of
+households grows, since every query is scoped to one household by an index.
+"""
+import argparse
+import json
+import os
+import sys
+import tempfile
+import time
+
+from benchmark.__main__ import ROUTES, percentile, peak_rss_kb
+
+TENANTS = [1, 10, 100, 1000]
+
+def measure(A, routes, nrequests, users):
+    from sqlalchemy import event
+    from sqlalchemy.engine import Engine
+
+    queries = [0]
+    def count_query(*args):
+        queries[0] += 1
+    event.listen(Engine, 'before_cursor_execute', count_query)
+
+    clients = []
+    for user in users:
+        client = A.app.test_client()
+        with client.session_transaction() as session:
+            session['_user_id'] = user
+            session['_fresh'] = True
+        clients.append(client)
+
+    results = {}
+    for route in routes:
+        # one untimed request per household so lazy setup isn't counted
+        for client in clients:
+            client.get(route)
+        latencies = []
+        queries[0] = 0
+        for i in range(nrequests):
+            client = clients[i % len(clients)]
+            start = time.perf_counter()
+            response = client.get(route)
+            response.get_data()
+            latencies.append(time.perf_counter() - start)
+            if response.status_code != 200:
+                raise RuntimeError("%s returned %d" % (route, response.status_code))
+        results[route] = {
+            'p50_ms': percentile(latencies, 0.50) * 1000,
+            'p95_ms': percentile(latencies, 0.95) * 1000,
+            'queries_per_request': queries[0] / nrequests,
+        }
+    event.remove(Engine, 'before_cursor_execute', count_query)
+    return results
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark per-request overhead as the number of households grows.")
+    parser.add_argument('--tenants', type=int, nargs='+', default=TENANTS)
+    parser.add_argument('--purchases', type=int, default=100, help='per household')
+    parser.add_argument('--groceries', type=int, default=20, help='per household')
+    parser.add_argument('--weeks', type=int, default=4, help='per household')
+    parser.add_argument('--requests', type=int, default=200, help='timed requests per route')
+    parser.add_argument('--routes', nargs='+', default=ROUTES)
+    parser.add_argument('--output', help='write results as JSON here')
+    args = parser.parse_args()
+
+    db_path = os.path.join(tempfile.mkdtemp(), 'tenants.db')
+    os.environ['DATABASE_URI'] = 'sqlite:///' + db_path
+    sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+    import app as A
+    from benchmark.seed import seed, member_names
+
+    results = {}
+    with A.app.app_context():
+        for tenants in args.tenants:
+            print("Seeding %d households..." % tenants)
+            seed(A, args.purchases, args.purchases // 10, args.groceries, args.weeks, households=tenants)
+            A.app.test_cli_runner().invoke(args=['rebuild-balances'])
+            A.app.test_cli_runner().invoke(args=['rebuild-rollups'])
+            # versions start over in the new database, so cached entries would look current
+            for stale in (A.page_cache, A.user_cache, A.roster_cache):
+                stale.clear()
+            A.db.session.remove()
+            users = [member_names(A, household_id)[0] for household_id in range(A.DEFAULT_HOUSEHOLD_ID, A.DEFAULT_HOUSEHOLD_ID + tenants)]
+            results[tenants] = measure(A, args.routes, args.requests, users)
+            for route, result in results[tenants].items():
+                print("%5d households  %-22s p50 %8.2fms  p95 %8.2fms  %5.1f queries" % (tenants, route, result['p50_ms'], result['p95_ms'], result['queries_per_request']))
+
+    print("Peak RSS: %d KB" % peak_rss_kb())
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump({'config': vars(args), 'tenants': results, 'peak_rss_kb': peak_rss_kb()}, f, indent=2)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,109 @@
+"""
+Small thread-safe caches: LRUCache keeps entries in memory, DiskCache keeps
+string values as files. Hits and misses are counted in metrics under the
+cache's name.
+"""
+from collections import OrderedDict
+import hashlib
+import os
+import threading
+import time
+import metrics
+
+metrics.describe('groomsgang_cache_hits_total', 'Cache hits, by cache.')
+metrics.describe('groomsgang_cache_misses_total', 'Cache misses, by cache.')
+
+MISSING = object()
+
+class LRUCache:
+    """Keeps the maxsize most recently used entries, each for at most ttl seconds (None for forever)."""
+
+    def __init__(self, name, maxsize=128, ttl=None):
+        self.name = name
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.entries = OrderedDict() # key -> (expires, value)
+        self.lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self.lock:
+            entry = self.entries.get(key, MISSING)
+            if entry is not MISSING and entry[0] is not None and entry[0] < time.monotonic():
+                del self.entries[key]
+                entry = MISSING
+            if entry is not MISSING:
+                self.entries.move_to_end(key)
+        if entry is MISSING:
+            metrics.inc('groomsgang_cache_misses_total', {'cache': self.name})
+            return default
+        metrics.inc('groomsgang_cache_hits_total', {'cache': self.name})
+        return entry[1]
+
+    def set(self, key, value):
+        expires = time.monotonic() + self.ttl if self.ttl is not None else None
+        with self.lock:
+            self.entries[key] = (expires, value)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.maxsize:
+                self.entries.popitem(last=False)
+
+    def delete(self, key):
+        with self.lock:
+            self.entries.pop(key, None)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+class DiskCache:
+    """
+    Stores string values as files under directory, so they survive restarts and
+    are shared between processes. Keeps roughly the maxsize newest entries.
+    """
+
+    def __init__(self, name, directory, maxsize=1024):
+        self.name = name
+        self.directory = directory
+        self.maxsize = maxsize
+        os.makedirs(directory, exist_ok=True)
+
+    def path(self, key):
+        return os.path.join(self.directory, hashlib.sha1(repr(key).encode('utf-8')).hexdigest())
+
+    def get(self, key, default=None):
+        try:
+            with open(self.path(key), 'r', encoding='utf-8') as f:
+                value = f.read()
+        except FileNotFoundError:
+            metrics.inc('groomsgang_cache_misses_total', {'cache': self.name})
+            return default
+        metrics.inc('groomsgang_cache_hits_total', {'cache': self.name})
+        return value
+
+    def set(self, key, value):
+        path = self.path(key)
+        tmp_path = '%s.%d.%d.tmp' % (path, os.getpid(), threading.get_ident())
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            f.write(value)
+        os.replace(tmp_path, path)
+        names = os.listdir(self.directory)
+        if len(names) > self.maxsize:
+            paths = sorted([os.path.join(self.directory, name) for name in names], key=os.path.getmtime)
+            for old_path in paths[:len(paths) - self.maxsize // 2]:
+                try:
+                    os.remove(old_path)
+                except FileNotFoundError:
+                    pass
+
+    def delete(self, key):
+        try:
+            os.remove(self.path(key))
+        except FileNotFoundError:
+            pass
+
+    def clear(self):
+        for name in os.listdir(self.directory):
+            try:
+                os.remove(os.path.join(self.directory, name))
+            except FileNotFoundError:
+                pass
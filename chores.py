@@ -0,0 +1,123 @@
+"""
+Decides who does which chore each week.
+
+The catalog is tasks.txt, one chore per line. A line can end with options
+separated by "|":
+
+    Clean windows | weight=3 | every=4
+
+weight is how much work the chore is (default 1) and every is how many weeks
+apart it comes up (default 1), counting from the last week it was given out.
+
+Chores are handed out heaviest first, each to whoever has the least total
+weight over the recent weeks, and among those to whoever did that chore
+least recently. Chores left unfinished last week stay with the same person.
+"""
+import collections
+import os
+import threading
+
+HISTORY_WEEKS = 8 # weeks of past assignments that count towards balancing
+
+class Chore:
+    def __init__(self, index, name, weight=1, every=1):
+        self.index = index # position in the catalog, used as the task id
+        self.name = name
+        self.key = name.lower()
+        self.weight = weight
+        self.every = every
+
+def parse(lines):
+    chores = []
+    for number, line in enumerate(lines, 1):
+        name, *options = [part.strip() for part in line.split('|')]
+        if not name:
+            continue
+        chore = Chore(len(chores), name)
+        for option in options:
+            key, _, value = option.partition('=')
+            key = key.strip()
+            if key not in ('weight', 'every'):
+                raise ValueError("Line %d: unknown option %r." % (number, option))
+            try:
+                value = int(value)
+            except ValueError:
+                raise ValueError("Line %d: %s must be a whole number." % (number, key))
+            if value < 1:
+                raise ValueError("Line %d: %s must be at least 1." % (number, key))
+            setattr(chore, key, value)
+        chores.append(chore)
+    return chores
+
+# path -> ((mtime, size), chores)
+catalogs = {}
+catalogs_lock = threading.Lock()
+
+def load(path):
+    """The parsed catalog at path, only re-read when the file changes."""
+    stat = os.stat(path)
+    stamp = (stat.st_mtime_ns, stat.st_size)
+    cached = catalogs.get(path)
+    if cached is not None and cached[0] == stamp:
+        return cached[1]
+    with open(path, 'r') as f:
+        chores = parse(f)
+    with catalogs_lock:
+        catalogs[path] = (stamp, chores)
+    return chores
+
+class History:
+    """Who did what in the weeks before the ones being planned."""
+
+    def __init__(self, chores):
+        self.weights = dict([(chore.key, chore.weight) for chore in chores])
+        self.load = collections.Counter() # member -> total weight
+        self.last_done = {} # (chore key, member) -> week
+        self.last_seen = {} # chore key -> week
+
+    def record(self, week, name, member):
+        key = name.lower()
+        self.load[member] += self.weights.get(key, 1)
+        self.last_done[(key, member)] = week
+        self.last_seen[key] = max(week, self.last_seen.get(key, week))
+
+    def seen(self, week, name):
+        # an assignment from before the balancing window, which only matters
+        # for when a chore with a long every comes up next
+        key = name.lower()
+        self.last_seen[key] = max(week, self.last_seen.get(key, week))
+
+    def due(self, chore, week):
+        last = self.last_seen.get(chore.key)
+        return last is None or week - last >= chore.every
+
+def plan(chores, members, weeks, history, carryover=None):
+    """
+    Assigns the chores that come up in each of weeks (in order) and returns
+    {week: [(chore, member, overdue)]} in catalog order. members are names in
+    roster order. carryover maps chore keys to whoever left them unfinished
+    the week before the first one, and only applies to that first week.
+    history is updated with the new assignments as it goes.
+    """
+    position = dict([(member, index) for index, member in enumerate(members)])
+    schedule = {}
+    if not members:
+        return dict([(week, []) for week in weeks])
+    for week in weeks:
+        assignments = []
+        todo = []
+        for chore in chores:
+            member = (carryover or {}).get(chore.key)
+            if member in position:
+                assignments.append((chore, member, True))
+                history.record(week, chore.name, member)
+            elif history.due(chore, week):
+                todo.append(chore)
+        todo.sort(key=lambda chore: (-chore.weight, chore.index))
+        for chore in todo:
+            member = min(members, key=lambda member: (history.load[member], history.last_done.get((chore.key, member), -1), position[member]))
+            assignments.append((chore, member, False))
+            history.record(week, chore.name, member)
+        schedule[week] = sorted(assignments, key=lambda assignment: assignment[0].index)
+        carryover = None
+    return schedule
@@ -0,0 +1,227 @@
+"""
+An in-process change feed. Views publish small deltas for a household after
+they commit, and a separate asyncio server streams them to browsers as
+Server-Sent Events. An idle connection is just a coroutine waiting for the
+next event, so thousands of open pages don't tie up waitress's worker threads.
+
+Event ids are "<start time>-<n>" with n counting up per household. A browser
+that reconnects sends the last id it saw and gets whatever it missed, or a
+"reload" event if that's no longer known (too old, or the server restarted).
+"""
+import asyncio
+import collections
+import json
+import threading
+import time
+import urllib.parse
+
+HISTORY = 100 # events kept per household for reconnects
+HEARTBEAT = 15 # seconds between keep-alive comments, which also notice dead connections
+MAX_PENDING = 256 # events a slow client may fall behind before it's disconnected
+RETRY_MS = 3000 # how long browsers wait before reconnecting
+REQUEST_TIMEOUT = 10 # seconds to send the request headers
+WRITE_TIMEOUT = 10
+
+class Subscription:
+    def __init__(self, household_id):
+        self.household_id = household_id
+        self.pending = collections.deque()
+        self.last_id = 0 # so events replayed on reconnect aren't delivered twice
+        self.wakeup = asyncio.Event()
+        self.dropped = False
+
+class Broker:
+    """
+    Keeps the recent events and the open subscriptions per household.
+    publish() may be called from any thread; subscriptions live on the
+    server's event loop.
+    """
+
+    def __init__(self, history=HISTORY):
+        self.lock = threading.Lock()
+        self.epoch = str(int(time.time()))
+        self.history_size = history
+        self.history = {}
+        self.counters = collections.Counter()
+        self.subscriptions = collections.defaultdict(set)
+        self.loop = None
+
+    @property
+    def running(self):
+        return self.loop is not None
+
+    def publish(self, household_id, name, data):
+        # nothing is kept when no server is running, e.g. in cli commands
+        if self.loop is None:
+            return
+        with self.lock:
+            self.counters[household_id] += 1
+            event = (self.counters[household_id], name, json.dumps(data, separators=(',', ':')))
+            if household_id not in self.history:
+                self.history[household_id] = collections.deque(maxlen=self.history_size)
+            self.history[household_id].append(event)
+        self.loop.call_soon_threadsafe(self.deliver, household_id, event)
+
+    def deliver(self, household_id, event):
+        for subscription in list(self.subscriptions.get(household_id, ())):
+            if event[0] <= subscription.last_id:
+                continue
+            if len(subscription.pending) >= MAX_PENDING:
+                subscription.dropped = True
+            else:
+                subscription.pending.append(event)
+                subscription.last_id = event[0]
+            subscription.wakeup.set()
+
+    def subscribe(self, household_id, last_event_id=None):
+        subscription = Subscription(household_id)
+        if last_event_id:
+            subscription.pending.extend(self.missed(household_id, last_event_id))
+            if subscription.pending:
+                subscription.last_id = subscription.pending[-1][0]
+        self.subscriptions[household_id].add(subscription)
+        return subscription
+
+    def unsubscribe(self, subscription):
+        subscriptions = self.subscriptions.get(subscription.household_id)
+        if subscriptions is not None:
+            subscriptions.discard(subscription)
+            if not subscriptions:
+                del self.subscriptions[subscription.household_id]
+
+    def missed(self, household_id, last_event_id):
+        # events after last_event_id, or a reload if they can't all be replayed
+        with self.lock:
+            history = list(self.history.get(household_id, ()))
+            newest = self.counters[household_id]
+        epoch, _, n = last_event_id.partition('-')
+        try:
+            n = int(n)
+        except ValueError:
+            n = None
+        if epoch != self.epoch or n is None or n > newest:
+            return [(newest, 'reload', '{}')]
+        if n == newest:
+            return []
+        if not history or history[0][0] > n + 1:
+            return [(newest, 'reload', '{}')]
+        return [event for event in history if event[0] > n]
+
+    def connections(self):
+        return sum([len(subscriptions) for subscriptions in self.subscriptions.values()])
+
+    def format(self, event):
+        id, name, data = event
+        return ("id: %s-%d\nevent: %s\ndata: %s\n\n" % (self.epoch, id, name, data)).encode('utf-8')
+
+async def read_request(reader):
+    # returns (path, query, headers) of a GET request
+    request_line = (await reader.readline()).decode('latin-1').split()
+    headers = {}
+    while True:
+        line = (await reader.readline()).decode('latin-1')
+        if line in ('\r\n', '\n', ''):
+            break
+        name, _, value = line.partition(':')
+        headers[name.strip().lower()] = value.strip()
+    if len(request_line) != 3 or request_line[0] != 'GET':
+        raise ValueError("Only GET is supported.")
+    url = urllib.parse.urlsplit(request_line[1])
+    return url.path, dict(urllib.parse.parse_qsl(url.query)), headers
+
+def error_response(status, message):
+    body = message.encode('utf-8')
+    return ("HTTP/1.1 %s\r\nContent-Type: text/plain\r\nContent-Length: %d\r\nAccess-Control-Allow-Origin: *\r\nConnection: close\r\n\r\n" % (status, len(body))).encode('latin-1') + body
+
+STREAM_HEADERS = (
+    "HTTP/1.1 200 OK\r\n"
+    "Content-Type: text/event-stream\r\n"
+    "Cache-Control: no-cache\r\n"
+    "Access-Control-Allow-Origin: *\r\n"
+    "X-Accel-Buffering: no\r\n"
+    "Connection: keep-alive\r\n"
+    "\r\n"
+    "retry: %d\n\n" % RETRY_MS
+).encode('latin-1')
+
+async def write(writer, data):
+    writer.write(data)
+    await asyncio.wait_for(writer.drain(), WRITE_TIMEOUT)
+
+async def wait_for_hangup(reader):
+    try:
+        await reader.read(1)
+    except ConnectionError:
+        pass
+
+def handler(broker, authenticate, path='/events'):
+    """
+    authenticate(token) returns the household id the token is for, or None.
+    The token comes from the ?token= query parameter, since EventSource can't
+    send headers or cross-origin cookies.
+    """
+    async def handle(reader, writer):
+        subscription = None
+        hangup = None
+        try:
+            try:
+                request_path, query, headers = await asyncio.wait_for(read_request(reader), REQUEST_TIMEOUT)
+            except (ValueError, asyncio.TimeoutError):
+                await write(writer, error_response('400 Bad Request', "Bad request."))
+                return
+            if request_path != path:
+                await write(writer, error_response('404 Not Found', "Not found."))
+                return
+            household_id = authenticate(query.get('token', ''))
+            if household_id is None:
+                await write(writer, error_response('403 Forbidden', "Bad or expired token."))
+                return
+            subscription = broker.subscribe(household_id, headers.get('last-event-id') or query.get('last_event_id'))
+            await write(writer, STREAM_HEADERS)
+            # the browser never sends anything else, so this finishing means it went away
+            hangup = asyncio.ensure_future(wait_for_hangup(reader))
+            while not (subscription.dropped or hangup.done()):
+                while subscription.pending:
+                    await write(writer, broker.format(subscription.pending.popleft()))
+                subscription.wakeup.clear()
+                wakeup = asyncio.ensure_future(subscription.wakeup.wait())
+                done, _ = await asyncio.wait([wakeup, hangup], timeout=HEARTBEAT, return_when=asyncio.FIRST_COMPLETED)
+                wakeup.cancel()
+                if not done:
+                    await write(writer, b": ping\n\n")
+        except (ConnectionError, asyncio.TimeoutError):
+            pass
+        finally:
+            if hangup is not None:
+                hangup.cancel()
+            if subscription is not None:
+                broker.unsubscribe(subscription)
+            writer.close()
+    return handle
+
+async def serve(broker, host, port, authenticate, ready=None):
+    server = await asyncio.start_server(handler(broker, authenticate), host, port, reuse_address=True)
+    broker.loop = asyncio.get_running_loop()
+    if ready is not None:
+        ready.set()
+    async with server:
+        await server.serve_forever()
+
+def start(broker, host, port, authenticate):
+    """Runs the event server on a daemon thread and returns once it's listening."""
+    ready = threading.Event()
+    errors = []
+    def run():
+        try:
+            asyncio.run(serve(broker, host, port, authenticate, ready))
+        except BaseException as e:
+            errors.append(e)
+        finally:
+            broker.loop = None
+            ready.set()
+    thread = threading.Thread(target=run, name='events', daemon=True)
+    thread.start()
+    ready.wait()
+    if errors:
+        raise errors[0]
+    return thread
@@ -0,0 +1,147 @@
+"""
+Per-endpoint request latency, SQL statement counts/durations and template
+render times, exposed in Prometheus text format at /metrics.
+
+Set SERVER_TIMING in the app config to also send a Server-Timing header.
+/metrics needs a logged-in user, or METRICS_TOKEN as a bearer token if the
+app config sets one.
+"""
+from flask import g, request, has_request_context, Response, abort
+from flask_login import login_required
+from flask.signals import before_render_template, template_rendered
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+import hmac
+import threading
+import time
+
+BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+class Histogram:
+    def __init__(self):
+        self.buckets = [0] * len(BUCKETS)
+        self.sum = 0
+        self.count = 0
+
+    def observe(self, value):
+        for index, bound in enumerate(BUCKETS):
+            if value <= bound:
+                self.buckets[index] += 1
+        self.sum += value
+        self.count += 1
+
+lock = threading.Lock()
+histograms = {} # (name, labels) -> Histogram
+counters = {} # (name, labels) -> number
+descriptions = {
+    'groomsgang_request_seconds': 'Request latency by endpoint.',
+    'groomsgang_sql_seconds': 'Time spent in SQL per request, by endpoint.',
+    'groomsgang_sql_statements_total': 'SQL statements executed, by endpoint.',
+    'groomsgang_template_seconds': 'Template render time, by template.',
+}
+
+def observe(name, labels, value):
+    key = (name, tuple(sorted(labels.items())))
+    with lock:
+        if key not in histograms:
+            histograms[key] = Histogram()
+        histograms[key].observe(value)
+
+def inc(name, labels, value=1):
+    key = (name, tuple(sorted(labels.items())))
+    with lock:
+        counters[key] = counters.get(key, 0) + value
+
+def describe(name, text):
+    descriptions[name] = text
+
+def format_labels(labels, extra=()):
+    labels = list(labels) + list(extra)
+    if len(labels) == 0:
+        return ""
+    return "{" + ",".join(['%s="%s"' % (key, str(value).replace('\\', '\\\\').replace('"', '\\"')) for key, value in labels]) + "}"
+
+def render():
+    lines = []
+    with lock:
+        seen = set()
+        for (name, labels), histogram in sorted(histograms.items()):
+            if name not in seen:
+                seen.add(name)
+                lines.append("# HELP %s %s" % (name, descriptions.get(name, name)))
+                lines.append("# TYPE %s histogram" % name)
+            for index, bound in enumerate(BUCKETS):
+                lines.append("%s_bucket%s %d" % (name, format_labels(labels, [('le', bound)]), histogram.buckets[index]))
+            lines.append("%s_bucket%s %d" % (name, format_labels(labels, [('le', '+Inf')]), histogram.count))
+            lines.append("%s_sum%s %f" % (name, format_labels(labels), histogram.sum))
+            lines.append("%s_count%s %d" % (name, format_labels(labels), histogram.count))
+        for (name, labels), value in sorted(counters.items()):
+            if name not in seen:
+                seen.add(name)
+                lines.append("# HELP %s %s" % (name, descriptions.get(name, name)))
+                lines.append("# TYPE %s counter" % name)
+            lines.append("%s%s %s" % (name, format_labels(labels), value))
+    return "\n".join(lines) + "\n"
+
+def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    conn.info.setdefault('query_start', []).append(time.perf_counter())
+
+def after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    duration = time.perf_counter() - conn.info['query_start'].pop()
+    if has_request_context() and 'metrics_sql_count' in g:
+        g.metrics_sql_count += 1
+        g.metrics_sql_time += duration
+
+def init_app(app):
+    app.config.setdefault('SERVER_TIMING', False)
+    local = threading.local()
+
+    event.listen(Engine, 'before_cursor_execute', before_cursor_execute)
+    event.listen(Engine, 'after_cursor_execute', after_cursor_execute)
+
+    def on_before_render(sender, template, context, **extra):
+        if not hasattr(local, 'render_starts'):
+            local.render_starts = []
+        local.render_starts.append(time.perf_counter())
+
+    def on_rendered(sender, template, context, **extra):
+        duration = time.perf_counter() - local.render_starts.pop()
+        observe('groomsgang_template_seconds', {'template': template.name}, duration)
+        if has_request_context() and 'metrics_template_time' in g:
+            g.metrics_template_time += duration
+
+    before_render_template.connect(on_before_render, app, weak=False)
+    template_rendered.connect(on_rendered, app, weak=False)
+
+    @app.before_request
+    def start_timer():
+        g.metrics_start = time.perf_counter()
+        g.metrics_sql_count = 0
+        g.metrics_sql_time = 0
+        g.metrics_template_time = 0
+
+    @app.after_request
+    def record(response):
+        if 'metrics_start' not in g:
+            return response
+        total = time.perf_counter() - g.metrics_start
+        endpoint = request.endpoint or 'unknown'
+        observe('groomsgang_request_seconds', {'endpoint': endpoint}, total)
+        observe('groomsgang_sql_seconds', {'endpoint': endpoint}, g.metrics_sql_time)
+        inc('groomsgang_sql_statements_total', {'endpoint': endpoint}, g.metrics_sql_count)
+        if app.config['SERVER_TIMING']:
+            response.headers['Server-Timing'] = 'app;dur=%.1f, sql;dur=%.1f;desc="%d queries", render;dur=%.1f' % (total * 1000, g.metrics_sql_time * 1000, g.metrics_sql_count, g.metrics_template_time * 1000)
+        return response
+
+    def serve():
+        return Response(render(), mimetype='text/plain; version=0.0.4')
+
+    @app.route('/metrics')
+    def metrics():
+        # scrapers can't log in, so they send the token instead
+        token = app.config.get('METRICS_TOKEN')
+        if not token:
+            return login_required(serve)()
+        if not hmac.compare_digest(request.headers.get('Authorization', ''), 'Bearer ' + token):
+            abort(401)
+        return serve()
@@ -0,0 +1,102 @@
+"""
+Stores uploaded receipt files under the sha256 of their contents, so the same
+file uploaded twice is only kept once, and makes thumbnails of them. Pillow
+is optional: without it receipts are still stored and served, just without
+thumbnails or image details.
+"""
+import hashlib
+import os
+import tempfile
+
+try:
+    from PIL import Image, ImageOps
+except ImportError:
+    Image = None
+
+CHUNK_SIZE = 64 * 1024
+THUMBNAIL_SIZE = (320, 320)
+
+# leading bytes -> content type
+SIGNATURES = [
+    (b'\xff\xd8\xff', 'image/jpeg'),
+    (b'\x89PNG\r\n\x1a\n', 'image/png'),
+    (b'GIF87a', 'image/gif'),
+    (b'GIF89a', 'image/gif'),
+    (b'%PDF-', 'application/pdf'),
+]
+
+def sniff(head):
+    for signature, content_type in SIGNATURES:
+        if head.startswith(signature):
+            return content_type
+    if head[:4] == b'RIFF' and head[8:12] == b'WEBP':
+        return 'image/webp'
+    return None
+
+def relative_path(digest):
+    return os.path.join(digest[:2], digest)
+
+def thumbnail_relative_path(digest):
+    return relative_path(digest) + '.thumb.jpg'
+
+def store(stream, directory, max_bytes):
+    """
+    Copies stream into directory CHUNK_SIZE bytes at a time, hashing as it
+    goes, and returns (sha256 hex digest, content type, size). Raises
+    ValueError for files that are empty, too big or not an image or PDF.
+    """
+    os.makedirs(directory, exist_ok=True)
+    digest = hashlib.sha256()
+    size = 0
+    content_type = None
+    fd, tmp_path = tempfile.mkstemp(dir=directory, suffix='.upload')
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            while True:
+                chunk = stream.read(CHUNK_SIZE)
+                if not chunk:
+                    break
+                if size == 0:
+                    content_type = sniff(chunk)
+                    if content_type is None:
+                        raise ValueError("Receipts must be JPEG, PNG, GIF, WebP or PDF files.")
+                size += len(chunk)
+                if size > max_bytes:
+                    raise ValueError("Receipts can be at most %d MB." % (max_bytes // (1024 * 1024)))
+                digest.update(chunk)
+                f.write(chunk)
+        if size == 0:
+            raise ValueError("The receipt file is empty.")
+        digest = digest.hexdigest()
+        path = os.path.join(directory, relative_path(digest))
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        if os.path.exists(path):
+            os.remove(tmp_path)
+        else:
+            os.replace(tmp_path, path)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+    return digest, content_type, size
+
+def process(directory, digest, content_type):
+    """
+    Makes the thumbnail if it doesn't exist yet. Returns (details, whether
+    there is a thumbnail), where details is a dict for Receipt.itemdata.
+    This decodes the whole image, so it belongs off the request path.
+    """
+    path = os.path.join(directory, relative_path(digest))
+    details = {'content_type': content_type, 'size': os.path.getsize(path)}
+    if Image is None or not content_type.startswith('image/'):
+        return details, False
+    thumbnail_path = os.path.join(directory, thumbnail_relative_path(digest))
+    with Image.open(path) as image:
+        details.update(width=image.width, height=image.height, format=image.format)
+        if not os.path.exists(thumbnail_path):
+            thumbnail = ImageOps.exif_transpose(image)
+            thumbnail.thumbnail(THUMBNAIL_SIZE)
+            tmp_path = thumbnail_path + '.%d.tmp' % os.getpid()
+            thumbnail.convert('RGB').save(tmp_path, 'JPEG', quality=80)
+            os.replace(tmp_path, thumbnail_path)
+    return details, True
@@ -0,0 +1,102 @@
+"""
+Works out the fewest money transfers that settle everyone's debts.
+
+Members are just indexes into a balance list, so this doesn't care how many
+people live in the house. Balances are in integer cents: positive means the
+member is owed money, negative means they owe it, and they must sum to zero.
+"""
+import heapq
+
+# above this many members with a nonzero balance the exact search (2^n) is too
+# slow and settle() falls back to greedy
+EXACT_LIMIT = 12
+
+def net_balances(owes):
+    # owes[a][b] is how many cents a owes b. returns cents per member.
+    n = len(owes)
+    balances = [0] * n
+    for debtor in range(n):
+        for creditor in range(n):
+            if debtor != creditor:
+                cents = owes[debtor][creditor]
+                balances[debtor] -= cents
+                balances[creditor] += cents
+    return balances
+
+def settle_greedy(balances):
+    """
+    Repeatedly has the biggest debtor pay the biggest creditor. Needs at most
+    one fewer transfer than there are members with a nonzero balance, which is
+    often but not always the minimum. O(n log n).
+    """
+    creditors = [(-amount, member) for member, amount in enumerate(balances) if amount > 0]
+    debtors = [(amount, member) for member, amount in enumerate(balances) if amount < 0]
+    heapq.heapify(creditors)
+    heapq.heapify(debtors)
+    transfers = []
+    while creditors and debtors:
+        credit, creditor = heapq.heappop(creditors)
+        debt, debtor = heapq.heappop(debtors)
+        amount = min(-credit, -debt)
+        transfers.append((debtor, creditor, amount))
+        if -credit > amount:
+            heapq.heappush(creditors, (credit + amount, creditor))
+        if -debt > amount:
+            heapq.heappush(debtors, (debt + amount, debtor))
+    return transfers
+
+def settle_exact(balances):
+    """
+    Minimum number of transfers. Splitting the members into as many groups as
+    possible that each sum to zero, then settling each group on its own, takes
+    (members - groups) transfers, which is optimal. The grouping is found with
+    a dp over subsets, so this is O(2^n * n) in the number of nonzero members.
+    """
+    members = [member for member, amount in enumerate(balances) if amount != 0]
+    n = len(members)
+    full = (1 << n) - 1
+    sums = [0] * (full + 1)
+    for mask in range(1, full + 1):
+        low = mask & -mask
+        sums[mask] = sums[mask ^ low] + balances[members[low.bit_length() - 1]]
+
+    # groups[mask] is the most zero-sum groups the members in mask can form
+    groups = [0] * (full + 1)
+    for mask in range(1, full + 1):
+        best = 0
+        rest = mask
+        while rest:
+            low = rest & -rest
+            best = max(best, groups[mask ^ low])
+            rest ^= low
+        groups[mask] = best + (1 if sums[mask] == 0 else 0)
+
+    # walk back from the full set, removing one member at a time along an
+    # optimal path. every time the remaining set sums to zero a group ends.
+    transfers = []
+    group = []
+    mask = full
+    while mask:
+        rest = mask
+        while rest:
+            low = rest & -rest
+            if groups[mask ^ low] + (1 if sums[mask] == 0 else 0) == groups[mask]:
+                break
+            rest ^= low
+        group.append(members[low.bit_length() - 1])
+        mask ^= low
+        if sums[mask] == 0:
+            group_balances = [0] * len(balances)
+            for member in group:
+                group_balances[member] = balances[member]
+            transfers.extend(settle_greedy(group_balances))
+            group = []
+    return transfers
+
+def settle(balances, exact_limit=EXACT_LIMIT):
+    """Returns (debtor, creditor, cents) transfers that zero out balances."""
+    if sum(balances) != 0:
+        raise ValueError("Balances don't add up to zero.")
+    if len([amount for amount in balances if amount != 0]) <= exact_limit:
+        return settle_exact(balances)
+    return settle_greedy(balances)
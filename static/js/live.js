@@ -0,0 +1,28 @@
+// subscribes to the household's live updates (see /api/events) and calls
+// handlers[event name] with each event's data. pages work the same without
+// it, they just don't update on their own.
+function liveUpdates(handlers) {
+  if (!window.EventSource) {
+    return;
+  }
+  $.getJSON('/api/events').done(function(data) {
+    var source = new EventSource(data.url);
+    $.each(handlers, function(name, handler) {
+      source.addEventListener(name, function(e) {
+        handler(JSON.parse(e.data));
+      });
+    });
+    source.addEventListener('reload', function() {
+      window.location.reload();
+    });
+    source.onerror = function() {
+      // the browser retries dropped connections by itself, but gives up on
+      // an expired token. get a new one.
+      if (source.readyState === EventSource.CLOSED) {
+        setTimeout(function() {
+          liveUpdates(handlers);
+        }, 30000);
+      }
+    };
+  });
+}
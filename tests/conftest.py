@@ -0,0 +1,11 @@
+import os
+import tempfile
+
+# app.py reads its configuration when it's imported, so point everything it
+# writes somewhere disposable before any test imports it
+directory = tempfile.mkdtemp()
+os.environ['DATABASE_URI'] = 'sqlite:///' + os.path.join(directory, 'test.db')
+os.environ['TEMPLATE_CACHE_DIR'] = os.path.join(directory, 'template_cache')
+os.environ['HOUSEHOLD_DIR'] = os.path.join(directory, 'households')
+os.environ['RECEIPT_DIR'] = os.path.join(directory, 'receipts')
+os.environ['EVENTS_PORT'] = '0'
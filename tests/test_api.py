@@ -0,0 +1,42 @@
+import pytest
+
+import app
+from benchmark.seed import seed
+
+@pytest.fixture
+def client():
+    with app.app.app_context():
+        seed(app, purchases=0, transfers=0, groceries=5, weeks=1)
+        app.db.session.remove()
+    client = app.app.test_client()
+    with client.session_transaction() as session:
+        session['_user_id'] = app.roommates[0]
+        session['_fresh'] = True
+    return client
+
+def test_invalid_task_rolls_back_the_batch(client):
+    week = app.get_week_id()
+    tasks = client.get('/api/tasks/%d' % week).get_json()['tasks']
+    first = [task for task in tasks if not task['completed']][0]
+    response = client.post('/api/tasks/%d' % week, json={'operations': [{'action': 'complete', 'id': first['id']}, {'action': 'complete', 'id': 100000}]})
+    assert response.status_code == 400
+    assert 'error' in response.get_json()
+    assert client.get('/api/tasks/%d' % week).get_json()['tasks'] == tasks
+
+def test_invalid_grocery_rolls_back_the_batch(client):
+    before = client.get('/api/groceries?show_bought').get_json()['groceries']
+    operations = [
+        {'action': 'add', 'name': 'Oat milk', 'quantity': 2, 'note': ''},
+        {'action': 'vote', 'id': before[0]['id']},
+        {'action': 'vote', 'id': 100000},
+    ]
+    response = client.post('/api/groceries', json={'operations': operations})
+    assert response.status_code == 400
+    assert client.get('/api/groceries?show_bought').get_json()['groceries'] == before
+
+def test_valid_batch_applies_everything(client):
+    week = app.get_week_id()
+    tasks = client.get('/api/tasks/%d' % week).get_json()['tasks']
+    response = client.post('/api/tasks/%d' % week, json={'operations': [{'action': 'complete', 'id': task['id']} for task in tasks[:2]]})
+    assert response.status_code == 200
+    assert [task['completed'] for task in response.get_json()['tasks']] == [True, True]
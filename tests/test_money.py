@@ -0,0 +1,27 @@
+import pytest
+
+import app
+
+@pytest.mark.parametrize('total', [0, 1, 2, 99, 100, 101, 12345, app.MAX_CENTS - 1])
+@pytest.mark.parametrize('nways', [1, 2, 3, 4, 7])
+def test_split_cents_adds_up(total, nways):
+    shares = app.split_cents(total, nways)
+    assert len(shares) == nways
+    assert sum(shares) == total
+    assert max(shares) - min(shares) <= 1
+
+@pytest.mark.parametrize('value, cents', [('12.34', 1234), ('12', 1200), (' 0.1 ', 10), ('1.50', 150), ('12.340', 1234), ('0', 0), (7, 700)])
+def test_parse_cents(value, cents):
+    assert app.parse_cents(value) == cents
+
+@pytest.mark.parametrize('value', ['', 'abc', '1.2.3', '$5', 'nan', 'inf', None, '12.345', '0.001', '1e-3'])
+def test_parse_cents_rejects(value):
+    with pytest.raises(ValueError):
+        app.parse_cents(value)
+
+def test_parse_cents_doesnt_go_through_floats():
+    # 0.1 + 0.2 as floats is 0.30000000000000004
+    assert app.parse_cents('0.1') + app.parse_cents('0.2') == app.parse_cents('0.3')
+
+def test_dollars():
+    assert [app.dollars(cents) for cents in (0, 5, 1234, -5, -1234)] == ['0.00', '0.05', '12.34', '-0.05', '-12.34']
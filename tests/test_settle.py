@@ -0,0 +1,60 @@
+import itertools
+import random
+
+import pytest
+
+import settle
+
+def apply(balances, transfers):
+    balances = list(balances)
+    for debtor, creditor, cents in transfers:
+        assert cents > 0
+        balances[debtor] += cents
+        balances[creditor] -= cents
+    return balances
+
+def random_balances(rng, n):
+    balances = [rng.randint(-50000, 50000) for _ in range(n - 1)]
+    return balances + [-sum(balances)]
+
+def test_exact_settles_everyone():
+    rng = random.Random(0)
+    for n in range(1, 9):
+        for _ in range(20):
+            balances = random_balances(rng, n)
+            assert apply(balances, settle.settle_exact(balances)) == [0] * n
+
+def test_exact_beats_greedy():
+    # 2 and 4 cancel out, which greedy misses by paying the biggest debt first
+    balances = [500, 300, 700, 500, -700, -1300]
+    assert len(settle.settle_greedy(balances)) == 5
+    assert len(settle.settle_exact(balances)) == 4
+
+def test_exact_is_minimal():
+    # brute force: the fewest transfers is members minus the most zero-sum groups
+    rng = random.Random(1)
+    for _ in range(30):
+        balances = random_balances(rng, 6)
+        members = [member for member, amount in enumerate(balances) if amount != 0]
+        most = max([len(groups) for groups in partitions(members) if all([sum([balances[member] for member in group]) == 0 for group in groups])], default=0)
+        assert len(settle.settle_exact(balances)) == len(members) - most
+
+def partitions(members):
+    if not members:
+        yield []
+        return
+    first, rest = members[0], members[1:]
+    for size in range(len(rest) + 1):
+        for others in itertools.combinations(rest, size):
+            remaining = [member for member in rest if member not in others]
+            for groups in partitions(remaining):
+                yield [[first] + list(others)] + groups
+
+def test_greedy_settles_everyone():
+    rng = random.Random(2)
+    balances = random_balances(rng, 40)
+    assert apply(balances, settle.settle(balances)) == [0] * 40
+
+def test_unbalanced_balances_are_refused():
+    with pytest.raises(ValueError):
+        settle.settle([100, -50])